@@ -0,0 +1,166 @@
+import bisect
+import heapq
+import logging
+
+from util import BackgroundIndex
+
+
+AUTOCOMPLETE_MAX_RESULTS = 20
+AUTOCOMPLETE_PRECOMPUTED_LENGTH = 3
+AUTOCOMPLETE_CANDIDATES = 50
+
+
+def normalize(text):
+    if not isinstance(text, unicode):
+        text = text.decode('utf-8')
+    return u' '.join(text.lower().split())
+
+
+def get_completions(track):
+    # Returns the (text, type) tuples a track can be found by
+    musicinfo = track.get('musicinfo', {})
+    completions = []
+    if track.get('title'):
+        completions.append((track['title'], 'title'))
+    if musicinfo.get('artist_name'):
+        completions.append((musicinfo['artist_name'], 'artist'))
+    if musicinfo.get('track_name'):
+        completions.append((musicinfo['track_name'], 'track'))
+    for tag in musicinfo.get('tags', {}).get('vartags', []):
+        completions.append((tag, 'tag'))
+    return completions
+
+
+class Autocomplete(BackgroundIndex):
+    # Prefix index over titles, artists, track names and tags. The keys are kept sorted, so every prefix
+    # maps to a range of keys. Short prefixes match too many keys to rank on the fly, so we keep a ranked
+    # list of candidates for them, which is longer than the number of completions we return.
+
+    def __init__(self):
+        BackgroundIndex.__init__(self)
+        self.logger = logging.getLogger(__name__)
+
+        self.keys = []
+        self.entries = {}
+        self.track_entries = {}
+        self.top = {}
+
+    def start(self, database):
+        def build():
+            index = Autocomplete()
+            index.ready = True
+            projection = {'title': 1, 'musicinfo.artist_name': 1, 'musicinfo.track_name': 1,
+                          'musicinfo.tags.vartags': 1, 'stats.playlisted': 1}
+            for track in database.get_all_tracks(projection=projection):
+                index._add_track(track)
+            index.keys = sorted(index.entries)
+
+            prefixes = {}
+            for key in index.keys:
+                for length in xrange(1, min(key.index(u'\0'), AUTOCOMPLETE_PRECOMPUTED_LENGTH) + 1):
+                    prefixes.setdefault(key[:length], []).append(key)
+            for prefix, keys in prefixes.iteritems():
+                index.top[prefix] = index._candidates(keys)
+            return index
+
+        def swap(index):
+            self.keys = index.keys
+            self.entries = index.entries
+            self.track_entries = index.track_entries
+            self.top = index.top
+            self.logger.info('Built autocomplete index (%s completions)', len(self.keys))
+
+        return self.build_in_background(database.threadpool, build, swap, 'autocomplete index')
+
+    def _apply(self, tracks):
+        for track in tracks:
+            for key, delta in self._add_track(track):
+                self._update(key, delta)
+
+    def _add_track(self, track):
+        # Updates the weights of the entries of the track, and returns the changed (key, delta) tuples
+        keys, weight = self.track_entries.pop(track['_id'], ((), 0))
+        deltas = dict((key, -weight) for key in keys)
+
+        # Popular tracks should be completed first
+        texts = {}
+        keys, weight = [], 1 + max(track.get('stats', {}).get('playlisted', 0), 0)
+        for text, type in get_completions(track):
+            key = normalize(text) + u'\0' + type
+            if not key.startswith(u'\0') and key not in texts:
+                texts[key] = text
+                keys.append(key)
+                deltas[key] = deltas.get(key, 0) + weight
+
+        if keys:
+            self.track_entries[track['_id']] = (tuple(keys), weight)
+        deltas = [(key, delta) for key, delta in deltas.iteritems() if delta != 0]
+        for key, delta in deltas:
+            self.entries.setdefault(key, [texts.get(key), 0])[1] += delta
+        return deltas
+
+    def _update(self, key, delta):
+        index = bisect.bisect_left(self.keys, key)
+        exists = index < len(self.keys) and self.keys[index] == key
+        if self.entries[key][1] <= 0:
+            del self.entries[key]
+            if exists:
+                del self.keys[index]
+        elif not exists:
+            self.keys.insert(index, key)
+
+        weight = self.entries[key][1] if key in self.entries else 0
+        for length in xrange(1, min(key.index(u'\0'), AUTOCOMPLETE_PRECOMPUTED_LENGTH) + 1):
+            top = self.top.get(key[:length], None)
+            if top is not None:
+                self._update_candidates(top, key, weight)
+
+    def _update_candidates(self, top, key, weight):
+        # Every key that isn't a candidate weighs at most top[1], so a key that drops to that weight (or below)
+        # can no longer be ranked against them and stops being a candidate
+        candidates = top[0]
+        if key in candidates:
+            candidates.remove(key)
+        if weight > top[1]:
+            candidates.append(key)
+            candidates.sort(key=lambda k: (-self.entries[k][1], k))
+            while len(candidates) > AUTOCOMPLETE_CANDIDATES:
+                top[1] = max(top[1], self.entries[candidates.pop()][1])
+
+    def _candidates(self, keys):
+        # Returns the best keys, together with the weight of the best key that didn't make it
+        ranked = self._rank(keys, AUTOCOMPLETE_CANDIDATES + 1)
+        floor = self.entries[ranked[-1]][1] if len(ranked) > AUTOCOMPLETE_CANDIDATES else 0
+        return [ranked[:AUTOCOMPLETE_CANDIDATES], floor]
+
+    def _rank(self, keys, limit):
+        return [key for _, key in heapq.nsmallest(limit, ((-self.entries[key][1], key) for key in keys))]
+
+    def complete(self, prefix, limit=10):
+        # Returns (text, type, weight) tuples for the best completions of the prefix
+        prefix = normalize(prefix)
+        if not prefix:
+            return []
+        limit = min(limit, AUTOCOMPLETE_MAX_RESULTS)
+
+        top = self.top.get(prefix, None) if len(prefix) <= AUTOCOMPLETE_PRECOMPUTED_LENGTH else None
+        if top is not None and (len(top[0]) >= limit or top[1] == 0):
+            keys = top[0][:limit]
+        else:
+            # Either the prefix is long enough to match only a few keys, or so many candidates lost weight that we need to rank again
+            start = bisect.bisect_left(self.keys, prefix)
+            end = bisect.bisect_left(self.keys, prefix + u'\uffff')
+            if len(prefix) <= AUTOCOMPLETE_PRECOMPUTED_LENGTH:
+                top = self._candidates(self.keys[start:end])
+                if top[0]:
+                    self.top[prefix] = top
+                keys = top[0][:limit]
+            else:
+                keys = self._rank(self.keys[start:end], limit)
+
+        return [(self.entries[key][0], key.split(u'\0')[1], self.entries[key][1]) for key in keys]
+
+    def stats(self):
+        return {'ready': self.ready,
+                'completions': len(self.keys),
+                'prefixes': len(self.top)}
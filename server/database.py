@@ -3,18 +3,40 @@ import sys
 import copy
 import json
 import time
+import hmac
 import random
+import hashlib
 import binascii
+import threading
 import requests
 import logging
 
 from sources import *
 from metadata import *
-from pymongo import MongoClient
+from datetime import datetime
+from collections import OrderedDict
+from pymongo import MongoClient, UpdateOne, DeleteOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
+from bson import BSON
 from bson.objectid import ObjectId
 from pymongo.son_manipulator import SONManipulator
 from twisted.internet.defer import inlineCallbacks
-from twisted.internet import reactor, defer
+from twisted.internet import reactor, defer, threads, task
+from twisted.python.threadpool import ThreadPool
+
+TRACKS_BATCH_SIZE = 1000
+STATS_ID = 'catalogue'
+MONGO_MAX_THREADS = 10
+TRACK_CACHE_SIZE = 64 * 1024 * 1024
+INGEST_BATCH_SIZE = 1000
+CLICKLOG_FLUSH_SIZE = 500
+CLICKLOG_FLUSH_INTERVAL = 5
+CLICKLOG_MAX_PENDING = 20000
+USERS_TTL = 300
+CREDENTIALS_TTL = 60
+PASSWORD_HASH_ITERATIONS = 100000
+DUPLICATE_KEY_ERROR = 11000
+UPSERT_MAX_ATTEMPTS = 3
 
 
 class ObjectIdToString(SONManipulator):
@@ -23,6 +45,142 @@ class ObjectIdToString(SONManipulator):
         return son
 
 
+class DeferredDatabase(object):
+
+    def __init__(self, database, threadpool):
+        self.database = database
+        self.threadpool = threadpool
+
+    def __getattr__(self, name):
+        # Run the Database method in the thread pool and return a Deferred
+        func = getattr(self.database, name)
+        def wrap(*args, **kwargs):
+            return threads.deferToThreadPool(reactor, self.threadpool, func, *args, **kwargs)
+        return wrap
+
+
+class ClicklogBuffer(object):
+
+    def __init__(self, database, flush_size=CLICKLOG_FLUSH_SIZE, flush_interval=CLICKLOG_FLUSH_INTERVAL, max_pending=CLICKLOG_MAX_PENDING):
+        self.logger = logging.getLogger(__name__)
+
+        self.database = database
+        self.flush_size = flush_size
+        self.max_pending = max_pending
+        self.events = []
+        self.flushing = False
+        self.counters = {'received': 0, 'written': 0, 'dropped': 0, 'failed': 0}
+
+        task.LoopingCall(self.flush).start(flush_interval, now=False)
+        reactor.addSystemEventTrigger('before', 'shutdown', self.stop)
+
+    def add(self, events):
+        # Refuse the events if MongoDB can't keep up
+        self.counters['received'] += len(events)
+        if len(self.events) + len(events) > self.max_pending:
+            self.counters['dropped'] += len(events)
+            return False
+
+        self.events.extend(events)
+        if len(self.events) >= self.flush_size:
+            self.flush()
+        return True
+
+    def flush(self):
+        # Only a single insert is in flight at any time, events keep buffering in the meantime
+        if self.flushing or not self.events:
+            return defer.succeed(None)
+
+        events, self.events = self.events, []
+        self.flushing = True
+
+        def on_success(count):
+            self.counters['written'] += count
+            self.counters['failed'] += len(events) - count
+
+        def on_error(failure):
+            self.counters['failed'] += len(events)
+            self.logger.error('Failed to write %s clicklog event(s) (reason: %s)', len(events), failure.getErrorMessage())
+
+        def on_done(_):
+            self.flushing = False
+            if len(self.events) >= self.flush_size:
+                self.flush()
+
+        d = self.database.deferred.add_clicklogs(events)
+        d.addCallbacks(on_success, on_error)
+        d.addBoth(on_done)
+        return d
+
+    @inlineCallbacks
+    def stop(self):
+        # Write everything that is still buffered before the reactor stops
+        while self.flushing or self.events:
+            if self.flushing:
+                yield task.deferLater(reactor, 0.1, lambda: None)
+            else:
+                yield self.flush()
+
+    def stats(self):
+        return dict(self.counters, pending=len(self.events))
+
+
+class UserIndex(object):
+
+    def __init__(self, database, ttl=USERS_TTL, credentials_ttl=CREDENTIALS_TTL):
+        self.database = database
+        self.ttl = ttl
+        self.credentials_ttl = credentials_ttl
+        self.users = {}
+        self.last_refresh = 0
+        self.verified = {}
+        # Verified credentials are remembered by their HMAC, so we never keep plaintext passwords around
+        self.secret = os.urandom(32)
+        self.lock = threading.Lock()
+
+    def refresh(self):
+        users = self.database.db.users.find({})
+        with self.lock:
+            self.users = dict((user['name'], user) for user in users)
+            self.verified = {}
+            self.last_refresh = time.time()
+
+    def invalidate(self):
+        with self.lock:
+            self.last_refresh = 0
+
+    def verify(self, name, password):
+        now = time.time()
+        if now - self.last_refresh >= self.ttl:
+            self.refresh()
+
+        key = hmac.new(self.secret, name + '\0' + password, hashlib.sha256).digest()
+        with self.lock:
+            if self.verified.get(key, 0) > now:
+                return True
+            user = self.users.get(name)
+
+        if user is None:
+            return False
+
+        if 'salt' in user:
+            verified = hmac.compare_digest(hash_password(password, str(user['salt'])), str(user['password']))
+        else:
+            # Users from before we started hashing passwords, upgrade them on first use
+            verified = hmac.compare_digest(password, user['password'].encode('utf-8'))
+            if verified:
+                self.database.set_user_password(name, password)
+
+        if verified:
+            with self.lock:
+                self.verified[key] = now + self.credentials_ttl
+        return verified
+
+
+def hash_password(password, salt):
+    return binascii.b2a_hex(hashlib.pbkdf2_hmac('sha256', password, salt, PASSWORD_HASH_ITERATIONS))
+
+
 class Database(object):
 
     def __init__(self, config, db_name):
@@ -37,16 +195,58 @@ class Database(object):
         self.client = MongoClient(mongo_host, mongo_port)
         self.db = self.client[db_name]
         self.db.add_son_manipulator(ObjectIdToString())
-        self.db.tracks.ensure_index('link')
-
-        self.info = {'num_tracks': {}, 'status': 'idle'}
-        for track in self.db.tracks.find({}):
-            link_type = track['link'].split(':')[0]
-            self.info['num_tracks'][link_type] = self.info['num_tracks'].get(link_type, 0) + 1
+        self.ensure_unique_index(self.db.tracks, [('link', 1)])
+        self.ensure_unique_index(self.db.sources, [('site', 1), ('type', 1), ('data', 1)])
+        self.db.clicklog.ensure_index([('app', 1), ('_id', -1)])
+        self.db.index_queue.ensure_index('queued')
+        self.db.tracks.ensure_index('updated')
+
+        # Pymongo is blocking, so the reactor thread should use self.deferred instead of calling methods directly
+        if self.config.has_option('mongodb', 'max_threads'):
+            max_threads = int(self.config.get('mongodb', 'max_threads'))
+        else:
+            max_threads = MONGO_MAX_THREADS
+        self.threadpool = ThreadPool(maxthreads=max_threads, name='mongodb')
+        reactor.callWhenRunning(self.threadpool.start)
+        reactor.addSystemEventTrigger('during', 'shutdown', self.threadpool.stop)
+        self.deferred = DeferredDatabase(self, self.threadpool)
+
+        # Tracks are cached BSON encoded, which gives us their real size and a fresh copy on every lookup
+        if self.config.has_option('mongodb', 'track_cache_size'):
+            track_cache_size = int(self.config.get('mongodb', 'track_cache_size'))
+        else:
+            track_cache_size = TRACK_CACHE_SIZE
+        self.track_cache = LRUCache(track_cache_size)
+
+        self.clicklog_buffer = ClicklogBuffer(self)
+        self.user_index = UserIndex(self)
+
+        # Catalogue counters are kept up to date by add_tracks/add_source/create_session
+        stats = self.get_stats()
+        if stats is None:
+            self.logger.info('No catalogue stats found, rebuilding')
+            self.reconcile_stats()
+        elif 'playlisted_reconciled' not in stats:
+            # Tracks that were playlisted before we counted playlist memberships still have a count of 0
+            self.logger.info('Playlist counts have never been reconciled, rebuilding')
+            self.reconcile_playlisted()
 
         self.source_checker = None
         self.metadata_checker = None
 
+    def ensure_unique_index(self, collection, keys):
+        # Tracks and sources are added from several threads at once, the unique index turns concurrent inserts into merges
+        name = '_'.join('%s_%s' % key for key in keys)
+        index = collection.index_information().get(name)
+        if index is not None and not index.get('unique', False):
+            # Older databases have a non-unique index with the same name
+            collection.drop_index(name)
+        try:
+            collection.ensure_index(keys, unique=True)
+        except OperationFailure as e:
+            self.logger.error('Failed to create unique index %s on %s, remove the duplicates and restart (reason: %s)', name, collection.name, e)
+            collection.ensure_index(keys)
+
     def start_checking(self):
         self.source_checker = SourceChecker(self, self.config)
         self.metadata_checker = MetadataChecker(self, self.config)
@@ -55,10 +255,100 @@ class Database(object):
         self.add_track_cb = add_cb
         self.update_track_cb = update_cb
 
+    def call_track_cb(self, cb, tracks, new=False):
+        # Record the tracks in the index queue first, so that they are indexed even if we restart before the callback is done
+        self.queue_tracks(tracks, new)
+
+        # The callbacks use Twisted, so they always need to run in the reactor thread
+        if cb:
+            reactor.callFromThread(cb, tracks)
+
+    def queue_tracks(self, tracks, new=False):
+        # The queue has a single entry per track, the version tells us if the track was queued again while being indexed
+        if not tracks:
+            return
+        now = time.time()
+        update = {'$set': {'queued': now, 'attempts': 0, 'failed': False}, '$inc': {'version': 1}}
+        if new:
+            update['$set']['new'] = True
+        self.db.index_queue.bulk_write([UpdateOne({'_id': track['_id']}, update, upsert=True) for track in tracks], ordered=False)
+
+        # Lets tools/rebuild_index.py catch up with the tracks that changed while it was running
+        self.db.tracks.bulk_write([UpdateOne({'_id': track['_id']}, {'$set': {'updated': now}}) for track in tracks], ordered=False)
+
+    def get_index_queue(self, limit):
+        return list(self.db.index_queue.find({'failed': {'$ne': True}}).sort('queued', 1).limit(limit))
+
+    def remove_from_index_queue(self, entries):
+        if entries:
+            self.db.index_queue.bulk_write([DeleteOne({'_id': entry['_id'], 'version': entry['version']}) for entry in entries], ordered=False)
+
+    def retry_index_queue(self, entries, max_attempts):
+        # Moves the entries to the back of the queue. Entries that failed too often are set aside until their track is queued again.
+        if not entries:
+            return
+        now = time.time()
+        requests = []
+        for entry in entries:
+            update = {'$set': {'queued': now}, '$inc': {'attempts': 1}}
+            if entry.get('attempts', 0) + 1 >= max_attempts:
+                update['$set']['failed'] = True
+            requests.append(UpdateOne({'_id': entry['_id'], 'version': entry['version']}, update))
+        self.db.index_queue.bulk_write(requests, ordered=False)
+
+    def get_stats(self):
+        return self.db.stats.find_one({'_id': STATS_ID})
+
+    def update_stats(self, inc):
+        self.db.stats.update({'_id': STATS_ID}, {'$inc': inc}, upsert=True)
+
+    def reconcile_stats(self):
+        stats = {'_id': STATS_ID,
+                 'num_tracks': {},
+                 'num_sources': self.db.sources.count(),
+                 'num_sessions': self.db.sessions.count()}
+        for track in self.db.tracks.find({}, {'link': 1}):
+            link_type = track['link'].split(':')[0]
+            stats['num_tracks'][link_type] = stats['num_tracks'].get(link_type, 0) + 1
+        self.db.stats.replace_one({'_id': STATS_ID}, stats, upsert=True)
+        self.reconcile_playlisted()
+        return self.get_stats()
+
+    def reconcile_playlisted(self):
+        # Counts the playlists every track is in, which also fixes tracks that were playlisted before we kept count
+        playlisted = {}
+        for track_ids in self.get_playlist_track_ids():
+            for track_id in track_ids:
+                playlisted[track_id] = playlisted.get(track_id, 0) + 1
+
+        changed = [track['_id'] for track in self.db.tracks.find({'stats.playlisted': {'$exists': True}}, {'stats.playlisted': 1})
+                   if track['stats']['playlisted'] != playlisted.get(track['_id'], 0)]
+        track_ids = playlisted.keys()
+        for index in xrange(0, len(track_ids), TRACKS_BATCH_SIZE):
+            batch = track_ids[index:index+TRACKS_BATCH_SIZE]
+            changed.extend(track['_id'] for track in self.db.tracks.find({'_id': {'$in': batch}, 'stats.playlisted': {'$exists': False}}, {'_id': 1}))
+
+        for index in xrange(0, len(changed), TRACKS_BATCH_SIZE):
+            batch = changed[index:index+TRACKS_BATCH_SIZE]
+            self.db.tracks.bulk_write([UpdateOne({'_id': track_id}, {'$set': {'stats.playlisted': playlisted.get(track_id, 0)}}) for track_id in batch], ordered=False)
+            for track_id in batch:
+                self.track_cache.pop(track_id)
+            self.call_track_cb(self.update_track_cb, self.get_tracks(batch).values())
+
+        self.db.stats.update({'_id': STATS_ID}, {'$set': {'playlisted_reconciled': time.time()}}, upsert=True)
+        self.logger.info('Reconciled the playlist counts of %s track(s)', len(changed))
+        return len(changed)
+
     def add_source(self, source):
-        # Add to database
-        if not list(self.db.sources.find(source).limit(1)):
-            return self.db.sources.insert(source)
+        # Add to database (upserts bypass the SON manipulator, so we need to create the id ourselves)
+        try:
+            result = self.db.sources.update_one(source, {'$setOnInsert': {'_id': str(source.get('_id', ObjectId()))}}, upsert=True)
+        except DuplicateKeyError:
+            # The same source with different fields (e.g. last_check) already exists
+            return
+        if result.upserted_id is not None:
+            self.update_stats({'num_sources': 1})
+            return result.upserted_id
 
     def get_all_sources(self):
         return list(self.db.sources.find({}))
@@ -73,11 +363,10 @@ class Database(object):
         sessions = list(self.db.sessions.find({'_id': token}).limit(1))
         session = sessions[0] if sessions else None
         if resolve_tracks and session and 'playlists' in session:
+            track_ids = set(track_id for playlist in session['playlists'].values() for track_id in playlist['tracks'])
+            tracks = self.get_tracks(track_ids)
             for playlist in session['playlists'].values():
-                tracks = []
-                for track_id in playlist['tracks']:
-                    tracks.append(self.get_track(track_id))
-                playlist['tracks'] = tracks
+                playlist['tracks'] = [tracks.get(track_id) for track_id in playlist['tracks']]
         return session
 
     def create_session(self):
@@ -87,92 +376,256 @@ class Database(object):
             token = binascii.b2a_hex(os.urandom(20))
 
         self.db.sessions.insert({'_id': token,
-                                 'playlists': {}})
+                                 'playlists': {},
+                                 'version': 0})
+        self.update_stats({'num_sessions': 1})
         return token
 
     def update_session(self, token, playlists):
-        self.db.sessions.update({'_id': token}, {'$set': {'playlists': playlists}})
-
-    def add_tracks(self, tracks):
-        existing_tracks = list(self.db.tracks.find({'link': {'$in': [track['link'] for track in tracks]}}, {'link': 1, 'sources': 1, '_id': 1}))
-        existing_links = [track['link'] for track in existing_tracks]
-
-        to_insert = [track for track in tracks if track['link'] not in existing_links]
-
-        if to_insert:
-            self.db.tracks.insert(to_insert)
-
+        self.db.sessions.update({'_id': token}, {'$set': {'playlists': playlists}, '$inc': {'version': 1}})
+
+    def patch_session(self, token, version, update):
+        # Only apply the update if nobody else changed the session in the meantime
+        query = {'_id': token, 'version': version if version else {'$in': [0, None]}}
+        update.setdefault('$inc', {})['version'] = 1
+        result = self.db.sessions.update_one(query, update)
+        return result.modified_count == 1
+
+    def add_tracks(self, tracks, batch_size=INGEST_BATCH_SIZE):
+        result = {'inserted': 0, 'merged': 0, 'failed': 0}
+
+        # Remove duplicate links, while keeping the sources of every duplicate
+        tracks_by_link = OrderedDict()
+        for track in tracks:
+            if track['link'] in tracks_by_link:
+                sources = tracks_by_link[track['link']].setdefault('sources', [])
+                sources.extend(s for s in track.get('sources', []) if s not in sources)
+            else:
+                tracks_by_link[track['link']] = track
+
+        links = tracks_by_link.keys()
+        for index in xrange(0, len(links), batch_size):
+            batch = [tracks_by_link[link] for link in links[index:index+batch_size]]
+            for key, value in self._add_tracks_batch(batch).iteritems():
+                result[key] += value
+
+        return result
+
+    def _add_tracks_batch(self, tracks):
+        result = {'inserted': 0, 'merged': 0, 'failed': 0}
+
+        existing_tracks = {}
+        for track in self.db.tracks.find({'link': {'$in': [track['link'] for track in tracks]}}, {'link': 1, 'sources': 1, '_id': 1}):
+            existing_tracks[track['link']] = track
+
+        # Upsert tracks that are new or have new sources. Since links are unique, a track that another thread
+        # inserted in the meantime gets its sources merged instead. Upserts bypass the SON manipulator, so
+        # we need to create the ids ourselves.
+        to_write = []
+        for track in tracks:
+            existing_track = existing_tracks.get(track['link'])
+            sources = track.get('sources', [])
+            if existing_track is None or [source for source in sources if source not in existing_track.get('sources', [])]:
+                track['_id'] = str(track.get('_id', ObjectId()))
+                to_write.append(track)
+
+        upserted, failed = set(), set()
+        pending = range(len(to_write))
+        for attempt in xrange(UPSERT_MAX_ATTEMPTS):
+            if not pending:
+                break
+            requests = []
+            for index in pending:
+                track = to_write[index]
+                update = {'$setOnInsert': dict((k, v) for k, v in track.iteritems() if k != 'sources')}
+                if track.get('sources'):
+                    update['$addToSet'] = {'sources': {'$each': track['sources']}}
+                requests.append(UpdateOne({'link': track['link']}, update, upsert=True))
+
+            retry = []
+            try:
+                upserted.update(pending[index] for index in self.db.tracks.bulk_write(requests, ordered=False).upserted_ids)
+            except BulkWriteError as e:
+                upserted.update(pending[upsert['index']] for upsert in e.details['upserted'])
+                for error in e.details['writeErrors']:
+                    # Concurrent upserts of the same link can fail with a duplicate key error, trying again merges them
+                    if error['code'] == DUPLICATE_KEY_ERROR and attempt < UPSERT_MAX_ATTEMPTS - 1:
+                        retry.append(pending[error['index']])
+                    else:
+                        failed.add(pending[error['index']])
+            pending = retry
+
+        if failed:
+            self.logger.error('Failed to add %s track(s)', len(failed))
+        result['failed'] = len(failed)
+
+        inserted = [track for index, track in enumerate(to_write) if index in upserted]
+        result['inserted'] = len(inserted)
+        if inserted:
             # Update db stats
-            for track in to_insert:
-                link_type = track['link'].split(':')[0]
-                self.info['num_tracks'][link_type] = self.info['num_tracks'].get(link_type, 0) + 1
+            inc = {}
+            for track in inserted:
+                key = 'num_tracks.' + track['link'].split(':')[0]
+                inc[key] = inc.get(key, 0) + 1
+            self.update_stats(inc)
+
+            self.call_track_cb(self.add_track_cb, inserted, new=True)
 
-            if self.add_track_cb:
-                self.add_track_cb(to_insert)
+        # Merged tracks may have been inserted by someone else, so we need to look up their ids
+        merged_links = [track['link'] for index, track in enumerate(to_write) if index not in upserted and index not in failed]
+        if merged_links:
+            updated = list(self.db.tracks.find({'link': {'$in': merged_links}}, {'link': 1, 'sources': 1, '_id': 1}))
+            result['merged'] = len(updated)
 
-        # Merge sources
-        to_update = [track for track in existing_tracks if track['link'] in [t['link'] for t in tracks]]
-        for track in to_update:
-            self.db.tracks.update({'_id': track['_id']},{'$addToSet': {'sources': {'$each': t['sources']}}})
-            self.logger.debug('Merged sources for track %s', track['_id'])
+            for track in updated:
+                self.track_cache.pop(track['_id'])
+                self.logger.debug('Merged sources for track %s', track['_id'])
 
-        if self.update_track_cb and to_update:
-            self.update_track_cb(to_update)
+            self.call_track_cb(self.update_track_cb, updated)
 
-        return len(to_insert)
+        return result
 
     def add_track(self, track):
-        if self.add_tracks([track]) == 1:
+        if self.add_tracks([track])['inserted'] == 1:
             return list(self.db.tracks.find({'link': track['link']}).limit(1))[0]
         return False
 
     def get_track(self, track_id):
-        tracks = list(self.db.tracks.find({'_id': track_id}))
-        return tracks[0] if tracks else None
+        return self.get_tracks([track_id]).get(track_id)
+
+    def get_tracks(self, track_ids):
+        # Returns a dict mapping track ids to tracks (missing tracks are left out)
+        tracks = {}
+        missing = []
+        for track_id in set(track_ids):
+            data = self.track_cache.get(track_id)
+            if data is None:
+                missing.append(track_id)
+            else:
+                tracks[track_id] = BSON(data).decode()
+
+        for index in xrange(0, len(missing), TRACKS_BATCH_SIZE):
+            batch = missing[index:index+TRACKS_BATCH_SIZE]
+            # A track that is updated while we read it must not end up in the cache
+            generation = self.track_cache.generation
+            for track in self.db.tracks.find({'_id': {'$in': batch}}):
+                self.track_cache.set(track['_id'], BSON.encode(track), generation)
+                tracks[track['_id']] = track
+        return tracks
 
     def get_tracks_from_source(self, source_id):
         return list(self.db.tracks.find({'sources': {'$elemMatch': {'$eq': source_id}}}))
 
-    def get_random_tracks(self, limit=20):
+    def get_random_tracks(self, limit=20, exclude=None):
+        # Let MongoDB pick the tracks ($sample needs to be the first stage to avoid a collection scan)
+        exclude = set(exclude or [])
         tracks = []
-        for _ in range(limit):
-            skip = int(random.random() * self.db.tracks.count())
-            track = list(self.db.tracks.find().limit(-1).skip(skip))[0]
-            tracks.append(track)
-        return tracks
+        for track in self.db.tracks.aggregate([{'$sample': {'size': limit + len(exclude)}}]):
+            if track['_id'] not in exclude:
+                # $sample may return the same track more than once
+                exclude.add(track['_id'])
+                tracks.append(track)
+        return tracks[:limit]
+
+    def get_all_tracks(self, query=None, projection=None):
+        # Generator over all tracks matching the query, for building in-memory indices
+        for track in self.db.tracks.find(query or {}, projection).batch_size(TRACKS_BATCH_SIZE):
+            yield track
+
+    def get_tracks_page(self, after=None, limit=TRACKS_BATCH_SIZE, query=None):
+        # Pages through the tracks in _id order, which stays fast for every page (unlike skip)
+        query = dict(query or {})
+        if after is not None:
+            query['_id'] = {'$gt': after}
+        return list(self.db.tracks.find(query).sort('_id', 1).limit(limit))
+
+    def get_playlist_track_ids(self):
+        # Generator over the track ids of every playlist in every session
+        for session in self.db.sessions.find({}, {'playlists': 1}):
+            for playlist in session.get('playlists', {}).itervalues():
+                yield playlist['tracks']
 
     def set_track_musicinfo(self, track, musicinfo):
-        self.db.tracks.update({'_id': track['_id']}, {'$set': {'musicinfo': musicinfo}})
+        # Set the fields one by one, so we never overwrite the function counters
+        fields = dict(('musicinfo.' + k, v) for k, v in musicinfo.iteritems() if k != 'functions')
+        if fields:
+            self.db.tracks.update({'_id': track['_id']}, {'$set': fields})
+        self.track_cache.pop(track['_id'])
 
-        if self.update_track_cb:
-            self.update_track_cb([track])
+        self.call_track_cb(self.update_track_cb, [track])
 
     def update_function_counter(self, track_id, function, delta):
-        track = self.get_track(track_id)
-        musicinfo = track.get('musicinfo', {})
-        musicinfo['functions'] = musicinfo.get('functions', {})
-        musicinfo['functions'][function] = musicinfo['functions'].get(function, 0) + delta
-        track['musicinfo'] = musicinfo
-        self.db.tracks.update({'_id': track_id}, {'$set': {'musicinfo': musicinfo}})
+        self.update_function_counters([(track_id, function, delta)])
+
+    def update_function_counters(self, deltas, playlisted=None):
+        # Combine the (track_id, function, delta) tuples and the (track_id, delta) playlist counts into one $inc per track
+        incs = {}
+        for track_id, function, delta in deltas:
+            inc = incs.setdefault(track_id, {})
+            key = 'musicinfo.functions.' + function
+            inc[key] = inc.get(key, 0) + delta
+        for track_id, delta in playlisted or []:
+            inc = incs.setdefault(track_id, {})
+            inc['stats.playlisted'] = inc.get('stats.playlisted', 0) + delta
 
-        if self.update_track_cb:
-            self.update_track_cb([track])
+        if not incs:
+            return
+
+        self.db.tracks.bulk_write([UpdateOne({'_id': track_id}, {'$inc': inc}) for track_id, inc in incs.iteritems()], ordered=False)
+        for track_id in incs:
+            self.track_cache.pop(track_id)
+
+        tracks = self.get_tracks(incs.keys())
+        self.call_track_cb(self.update_track_cb, tracks.values())
 
     def add_clicklog(self, clicklog):
         return self.db.clicklog.insert(clicklog)
 
-    def get_clicklog(self, app=None, limit=0):
+    def add_clicklogs(self, clicklogs):
+        # Returns the number of inserted events (insert_many bypasses the SON manipulator, so we create the ids ourselves)
+        for clicklog in clicklogs:
+            clicklog['_id'] = str(clicklog.get('_id', ObjectId()))
+        try:
+            return len(self.db.clicklog.insert_many(clicklogs, ordered=False).inserted_ids)
+        except BulkWriteError as e:
+            return e.details['nInserted']
+
+    def get_clicklog_page(self, app=None, since=None, until=None, cursor=None, limit=0):
+        # Returns clicklog entries (newest first) that are older than the cursor
         query = {'app': app} if app != None else {}
-        return list(self.db.clicklog.find(query, {'_id': False}).sort('_id', -1).limit(int(limit)))
+        if cursor:
+            query['_id'] = {'$lt': cursor}
+        if since:
+            # The ids are generated after the event time, so we can use them to skip everything before since
+            query.setdefault('_id', {})['$gte'] = str(ObjectId.from_datetime(datetime.utcfromtimestamp(since)))
+            query['time'] = {'$gte': since}
+        if until:
+            # Events are written within CLICKLOG_FLUSH_INTERVAL seconds, so we can also use the ids to skip everything after until
+            until_id = str(ObjectId.from_datetime(datetime.utcfromtimestamp(until + CLICKLOG_FLUSH_INTERVAL)))
+            query.setdefault('_id', {})['$lt'] = min(cursor, until_id) if cursor else until_id
+            query.setdefault('time', {})['$lt'] = until
+        return list(self.db.clicklog.find(query).sort('_id', -1).limit(int(limit)))
 
     def add_user(self, name, password):
+        salt = binascii.b2a_hex(os.urandom(16))
         user = {'name': name,
-                'password': password}
+                'salt': salt,
+                'password': hash_password(password, salt)}
 
-        if not list(self.db.users.find(user).limit(1)):
-            return self.db.users.insert(user)
+        if not list(self.db.users.find({'name': name}).limit(1)):
+            user_id = self.db.users.insert(user)
+            self.user_index.invalidate()
+            return user_id
         return False
 
+    def set_user_password(self, name, password):
+        salt = binascii.b2a_hex(os.urandom(16))
+        self.db.users.update({'name': name}, {'$set': {'salt': salt, 'password': hash_password(password, salt)}})
+        self.user_index.invalidate()
+
+    def verify_user(self, name, password):
+        return self.user_index.verify(name, password)
+
     def get_users(self):
         return list(self.db.users.find({}))
 
@@ -188,11 +641,22 @@ class Database(object):
         waveforms = list(self.db.waveforms.find({'_id': track_id}))
         return waveforms[0] if waveforms else None
 
-    def get_info(self):
-        info = copy.deepcopy(self.info)
+    def get_waveforms(self, track_ids):
+        # Returns a dict mapping track ids to waveforms (missing waveforms are left out)
+        track_ids = list(track_ids)
+        waveforms = {}
+        for index in xrange(0, len(track_ids), TRACKS_BATCH_SIZE):
+            batch = track_ids[index:index+TRACKS_BATCH_SIZE]
+            for waveform in self.db.waveforms.find({'_id': {'$in': batch}}):
+                waveforms[waveform['_id']] = waveform['waveform']
+        return waveforms
 
-        info['num_sources'] = self.db.sources.count()
-        info['num_sessions'] = self.db.sessions.count()
+    def get_info(self):
+        info = self.get_stats() or {}
+        info.pop('_id', None)
+        info['track_cache'] = self.track_cache.stats()
+        info['clicklog'] = self.clicklog_buffer.stats()
+        info['index_queue'] = {'depth': self.db.index_queue.count({'failed': {'$ne': True}}), 'failed': self.db.index_queue.count({'failed': True})}
         info['status'] = []
 
         if self.source_checker.checking:
@@ -219,6 +683,10 @@ class Database(object):
         radios = list(self.db.radios.find({'session_id': session_id, 'playlist_name': playlist_name}).limit(1))
         return radios[0] if radios else None
 
+    def rename_radio(self, session_id, playlist_name, new_playlist_name):
+        self.db.radios.update_many({'session_id': session_id, 'playlist_name': playlist_name},
+                                   {'$set': {'playlist_name': new_playlist_name}})
+
     def get_radio(self, radio_id):
         radios = list(self.db.radios.find({'_id': radio_id}).limit(1))
         return radios[0] if radios else None
@@ -0,0 +1,475 @@
+import os
+import re
+import glob
+import json
+import math
+import mmap
+import time
+import heapq
+import array
+import logging
+
+from util import BackgroundIndex
+from collections import defaultdict
+from twisted.internet import reactor, defer, threads, task
+
+
+LOCAL_FLUSH_SIZE = 1000
+LOCAL_FLUSH_INTERVAL = 60
+LOCAL_MAX_SEGMENTS = 20
+LOCAL_MERGE_FACTOR = 4
+LOCAL_REBUILD_INTERVAL = 24 * 3600
+LOCAL_RECONCILE_MARGIN = 3600
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+CLAUSE_RE = re.compile(r'"([^"]*)"(?:\^([\d.]+))?|([^\s"]+)', re.UNICODE)
+SEGMENT_RE = re.compile(r'segment-(\d+)(?:-(\d+))?\.json$')
+
+
+def tokenize(text):
+    if not isinstance(text, unicode):
+        text = text.decode('utf-8', 'replace')
+    return TOKEN_RE.findall(text.lower())
+
+
+def parse_query(query):
+    # Supports the subset of the query_string syntax that we generate ourselves: terms and "phrases", both with an optional ^boost
+    clauses = []
+    for match in CLAUSE_RE.finditer(query if isinstance(query, unicode) else query.decode('utf-8', 'replace')):
+        phrase, phrase_boost, term = match.groups()
+        if phrase is not None:
+            tokens, boost = tokenize(phrase), float(phrase_boost or 1)
+        else:
+            term, _, term_boost = term.partition('^')
+            try:
+                boost = float(term_boost or 1)
+            except ValueError:
+                boost = 1.0
+            # A term that consists of several tokens (e.g. hip-hop) is searched for as a phrase
+            tokens = tokenize(term)
+        if tokens:
+            clauses.append((tokens, boost))
+    return clauses
+
+
+class MemorySegment(object):
+    # Segment that is still being added to. Once it's full it's written to disk and replaced by a DiskSegment.
+
+    def __init__(self, seq, generation=0):
+        self.seq = seq
+        self.generation = generation
+        # Time after which tracks no longer went into this segment (or any older one)
+        self.time = 0
+        self.docs = []
+        self.postings = defaultdict(list)
+
+    def add(self, track_id, sources, playlisted, fields):
+        # The document goes in before its postings, since searches may be reading the segment from another thread
+        doc = len(self.docs)
+        self.docs.append((track_id, sources, playlisted, dict((field, len(tokens)) for field, tokens in fields.iteritems())))
+        for field, tokens in fields.iteritems():
+            positions = defaultdict(list)
+            for position, token in enumerate(tokens):
+                positions[token].append(position)
+            for token, token_positions in positions.iteritems():
+                self.postings[field + u'\0' + token].append((doc, token_positions))
+        return doc
+
+    def df(self, key):
+        return len(self.postings.get(key, ()))
+
+    def get_postings(self, key):
+        return self.postings.get(key, ())
+
+    def write(self, path):
+        # Postings are stored as uint32 arrays of doc, tf, position1, ..., positionN per document
+        # Merged segments take the place of the newest segment they replace, so they get a new generation instead of a new seq
+        name = os.path.join(path, 'segment-%08d' % self.seq + ('-%d' % self.generation if self.generation else ''))
+        terms = {}
+        data = array.array('I')
+        for key, postings in self.postings.iteritems():
+            offset = len(data)
+            for doc, positions in postings:
+                data.append(doc)
+                data.append(len(positions))
+                data.extend(positions)
+            terms[key] = [offset, len(data) - offset, len(postings)]
+
+        if not os.path.exists(path):
+            os.makedirs(path)
+        with open(name + '.post', 'wb') as fp:
+            data.tofile(fp)
+        with open(name + '.json', 'wb') as fp:
+            json.dump({'docs': self.docs, 'terms': terms, 'time': self.time}, fp)
+        return DiskSegment(name, self.seq, self.generation)
+
+
+class DiskSegment(object):
+
+    def __init__(self, name, seq, generation=0):
+        self.name = name
+        self.seq = seq
+        self.generation = generation
+        with open(name + '.json', 'rb') as fp:
+            meta = json.load(fp)
+        self.docs = meta['docs']
+        self.terms = meta['terms']
+        self.time = meta.get('time', 0)
+
+        # Only the term dictionary is kept in memory, the postings are paged in by the OS when we need them
+        self.fp = open(name + '.post', 'rb')
+        self.mmap = mmap.mmap(self.fp.fileno(), 0, access=mmap.ACCESS_READ) if os.path.getsize(name + '.post') else ''
+
+    def df(self, key):
+        return self.terms[key][2] if key in self.terms else 0
+
+    def get_postings(self, key):
+        if key not in self.terms:
+            return
+        offset, count, _ = self.terms[key]
+        data = array.array('I')
+        data.fromstring(self.mmap[offset * data.itemsize:(offset + count) * data.itemsize])
+        index = 0
+        while index < len(data):
+            doc, tf = data[index], data[index + 1]
+            yield doc, data[index + 2:index + 2 + tf]
+            index += 2 + tf
+
+    def close(self):
+        if self.mmap:
+            self.mmap.close()
+        self.fp.close()
+
+    def remove(self):
+        self.close()
+        for extension in ['.post', '.json']:
+            os.remove(self.name + extension)
+
+
+class LocalIndex(BackgroundIndex):
+    # Inverted index with BM25 scoring that can stand in for Elasticsearch. Tracks are added to an in-memory
+    # segment, which is written to a memory-mapped segment file when it's full. The newest version of a track wins,
+    # older versions are skipped during searching and dropped when the segments are rebuilt.
+
+    def __init__(self, path, terms):
+        BackgroundIndex.__init__(self)
+        self.logger = logging.getLogger(__name__)
+
+        self.path = path
+        # Function that returns the index terms of a track
+        self.terms = terms
+
+        self.segments = []
+        # Maps track ids to the (segment, doc) of their newest version. Searches run in a thread, so the live map is
+        # replaced instead of modified. Only the tracks in the buffer are kept in a separate map that is copied per search.
+        self.live = {}
+        self.recent = {}
+        self.lengths = defaultdict(int)
+        self.seq = 0
+        self.buffer = None
+        self.rebuilding = False
+        self.merging = False
+        # Segments that are no longer used are only removed once no search is reading them
+        self.searches = 0
+        self.obsolete = []
+
+    def start(self, database, flush_interval=LOCAL_FLUSH_INTERVAL, rebuild_interval=LOCAL_REBUILD_INTERVAL):
+        self.database = database
+
+        names = []
+        for name in glob.glob(os.path.join(self.path, 'segment-*.json')):
+            match = SEGMENT_RE.search(name)
+            if match:
+                names.append((int(match.group(1)), int(match.group(2) or 0), name[:-5]))
+        if names:
+            self.build_in_background(None, lambda: [DiskSegment(name, seq, generation) for seq, generation, name in sorted(names)], self._loaded, 'local index')
+        else:
+            self.rebuild()
+
+        task.LoopingCall(self.flush).start(flush_interval, now=False)
+        task.LoopingCall(self.rebuild).start(rebuild_interval, now=False)
+        reactor.addSystemEventTrigger('before', 'shutdown', self.flush)
+
+    def _loaded(self, segments):
+        self.seq = max(segment.seq for segment in segments)
+        self.buffer = self._new_segment()
+        self.segments = segments + [self.buffer]
+        self._update_live()
+        self.logger.info('Loaded local index (%s segments, %s tracks)', len(segments), len(self.live))
+
+        since = max(segment.time for segment in segments)
+        if since:
+            self.reconcile(since)
+
+    def reconcile(self, since):
+        # The buffer is lost when we crash, even though the index queue is done with its tracks, so get the tracks that changed
+        # after the newest segment was written from MongoDB. The margin covers tracks that were still waiting in the index queue.
+        def build():
+            return list(self.database.get_all_tracks({'updated': {'$gte': since - LOCAL_RECONCILE_MARGIN}}, self._projection()))
+
+        def apply(tracks):
+            self.add_tracks(tracks)
+            self.logger.info('Reconciled local index (%s tracks changed)', len(tracks))
+
+        d = threads.deferToThreadPool(reactor, self.database.threadpool, build)
+        d.addCallbacks(apply, lambda failure: self.logger.error('Failed to reconcile local index (reason: %s)', failure.value))
+        return d
+
+    def _new_segment(self):
+        self.seq += 1
+        return MemorySegment(self.seq)
+
+    def _update_live(self):
+        # Searches that are still running keep using the old maps
+        live, lengths = {}, defaultdict(int)
+        for segment in self.segments:
+            for doc, (track_id, _, _, doc_lengths) in enumerate(segment.docs):
+                self._replace_lengths(lengths, live.get(track_id), doc_lengths)
+                live[track_id] = (segment, doc)
+        self.live, self.recent, self.lengths = live, {}, lengths
+
+    def _replace_lengths(self, lengths, old, doc_lengths):
+        # Updates the total field lengths for a document that replaces an older version (if any)
+        if old is not None:
+            old_segment, old_doc = old
+            for field, length in old_segment.docs[old_doc][3].iteritems():
+                lengths[field] -= length
+        for field, length in doc_lengths.iteritems():
+            lengths[field] += length
+
+    def _get_live(self, track_id):
+        return self.recent.get(track_id) or self.live.get(track_id)
+
+    def _snapshot(self):
+        # Returns a function that looks up the live (segment, doc) of a track as it is right now
+        live, recent = self.live, dict(self.recent)
+        return lambda track_id: recent.get(track_id) or live.get(track_id)
+
+    def _num_live(self):
+        return len(self.live) + sum(1 for track_id in self.recent if track_id not in self.live)
+
+    def _projection(self):
+        return {'title': 1, 'musicinfo': 1, 'sources': 1, 'stats.playlisted': 1}
+
+    def _fields(self, track):
+        return {'title': tokenize(track.get('title', '')),
+                'all': [token for term in self.terms(track) for token in tokenize(term)]}
+
+    def rebuild(self):
+        # Writes all tracks into a single new segment, which replaces all the segments that existed before we started
+        if self.rebuilding:
+            return
+        self.rebuilding = True
+        segment = self._new_segment()
+        segment.time = time.time()
+
+        # Tracks that are added from now on go into a newer segment, so they survive the swap
+        self.buffer = self._new_segment()
+        self.segments.append(self.buffer)
+
+        def build():
+            for track in self.database.get_all_tracks(projection=self._projection()):
+                segment.add(track['_id'], track.get('sources', []), track.get('stats', {}).get('playlisted', 0), self._fields(track))
+            return segment.write(self.path)
+
+        def swap(disk_segment):
+            old = [s for s in self.segments if s.seq < disk_segment.seq]
+            self.segments = [disk_segment] + [s for s in self.segments if s.seq > disk_segment.seq]
+            self._update_live()
+            self.logger.info('Built local index (%s tracks)', len(self.live))
+            self._remove([s for s in old if isinstance(s, DiskSegment)])
+
+        def done(result):
+            self.rebuilding = False
+            return result
+
+        d = self.build_in_background(self.database.threadpool, build, swap, 'local index')
+        d.addBoth(done)
+        return d
+
+    def _apply(self, tracks):
+        # Tracks that come in during a rebuild go into the buffer, which is newer than the segment being built
+        for track in tracks:
+            fields = self._fields(track)
+            doc = self.buffer.add(track['_id'], track.get('sources', []), track.get('stats', {}).get('playlisted', 0), fields)
+            self._replace_lengths(self.lengths, self._get_live(track['_id']), dict((field, len(tokens)) for field, tokens in fields.iteritems()))
+            self.recent[track['_id']] = (self.buffer, doc)
+        if len(self.buffer.docs) >= LOCAL_FLUSH_SIZE:
+            self.flush()
+
+    def flush(self):
+        # Writes the in-memory segment to disk, it stays searchable while it's being written
+        if self.buffer is None or not self.buffer.docs:
+            return defer.succeed(None)
+        segment, self.buffer = self.buffer, self._new_segment()
+        segment.time = time.time()
+        self.segments.append(self.buffer)
+
+        def swap(disk_segment):
+            if segment not in self.segments:
+                # A rebuild replaced the segment in the meantime
+                disk_segment.remove()
+                return
+            self.segments[self.segments.index(segment)] = disk_segment
+            live = dict(self.live)
+            for doc, (track_id, _, _, _) in enumerate(segment.docs):
+                if live.get(track_id) == (segment, doc) or self.recent.get(track_id) == (segment, doc):
+                    live[track_id] = (disk_segment, doc)
+            self.live = live
+            self.recent = dict((track_id, entry) for track_id, entry in self.recent.iteritems() if entry[0] is not segment)
+            if len(self.segments) > LOCAL_MAX_SEGMENTS:
+                self.merge()
+
+        d = threads.deferToThread(segment.write, self.path)
+        d.addCallback(swap)
+        d.addErrback(lambda failure: self.logger.error('Failed to write local index segment (reason: %s)', failure.value))
+        return d
+
+    def merge(self):
+        # Merges consecutive segments into one, leaving out the documents that were replaced by newer versions. Only the newest
+        # segments are picked, as long as each older segment isn't much bigger than the ones picked so far, so the big segments
+        # at the start only get merged every once in a while.
+        if self.merging or self.rebuilding:
+            return defer.succeed(None)
+
+        run = []
+        for segment in self.segments:
+            if not isinstance(segment, DiskSegment):
+                break
+            run.append(segment)
+        picked, num_docs = [], 0
+        for segment in reversed(run):
+            if picked and len(segment.docs) > LOCAL_MERGE_FACTOR * num_docs:
+                break
+            picked.insert(0, segment)
+            num_docs += len(segment.docs)
+        if len(picked) < 2:
+            return defer.succeed(None)
+        self.merging = True
+        live = self._snapshot()
+
+        def build():
+            merged = MemorySegment(picked[-1].seq, max(segment.generation for segment in picked if segment.seq == picked[-1].seq) + 1)
+            merged.time = max(segment.time for segment in picked)
+            origins = []
+            for segment in picked:
+                docs = {}
+                for doc, entry in enumerate(segment.docs):
+                    if live(entry[0]) == (segment, doc):
+                        docs[doc] = len(merged.docs)
+                        merged.docs.append(entry)
+                        origins.append((segment, doc))
+                for key in segment.terms:
+                    postings = [(docs[doc], list(positions)) for doc, positions in segment.get_postings(key) if doc in docs]
+                    if postings:
+                        merged.postings[key].extend(postings)
+            return merged.write(self.path), origins
+
+        def swap(result):
+            disk_segment, origins = result
+            if any(segment not in self.segments for segment in picked):
+                # A rebuild replaced the segments in the meantime
+                disk_segment.remove()
+                return
+            index = self.segments.index(picked[0])
+            self.segments[index:index + len(picked)] = [disk_segment]
+            live = dict(self.live)
+            for doc, origin in enumerate(origins):
+                if live.get(disk_segment.docs[doc][0]) == origin:
+                    live[disk_segment.docs[doc][0]] = (disk_segment, doc)
+            self.live = live
+            self._remove(picked)
+            self.logger.info('Merged %s local index segments (%s tracks)', len(picked), len(disk_segment.docs))
+
+        def done(result):
+            self.merging = False
+            return result
+
+        d = threads.deferToThread(build)
+        d.addCallback(swap)
+        d.addErrback(lambda failure: self.logger.error('Failed to merge local index segments (reason: %s)', failure.value))
+        d.addBoth(done)
+        return d
+
+    def _remove(self, segments):
+        self.obsolete.extend(segments)
+        if not self.searches:
+            obsolete, self.obsolete = self.obsolete, []
+            for segment in obsolete:
+                segment.remove()
+
+    def search(self, query, field='title', sources=None, exclude=None, offset=0, size=200, popularity=False):
+        # Returns a Deferred that fires with the total number of hits and the requested page of (track id, score) tuples.
+        # Decoding the postings takes a while for common terms, so it happens in a thread.
+        field = 'title' if field == 'title' else 'all'
+        num_docs = max(self._num_live(), 1)
+        avg_length = float(self.lengths[field]) / num_docs or 1.0
+
+        def done(result):
+            self.searches -= 1
+            self._remove([])
+            return result
+
+        self.searches += 1
+        d = threads.deferToThread(self._search, list(self.segments), self._snapshot(), query, field, set(sources or []), set(exclude or []),
+                                  offset, size, popularity, num_docs, avg_length)
+        d.addBoth(done)
+        return d
+
+    def _search(self, segments, live, query, field, sources, exclude, offset, size, popularity, num_docs, avg_length):
+        scores = defaultdict(float)
+        for tokens, boost in parse_query(query):
+            keys = [field + u'\0' + token for token in tokens]
+            idfs = {}
+            for key in keys:
+                df = sum(segment.df(key) for segment in segments)
+                idfs[key] = math.log(1 + (num_docs - df + 0.5) / (df + 0.5))
+
+            for segment in segments:
+                matches = self._phrase_matches(segment, keys) if len(keys) > 1 else None
+                for key in keys:
+                    for doc, positions in segment.get_postings(key):
+                        if matches is not None and doc not in matches:
+                            continue
+                        track_id, _, _, lengths = segment.docs[doc]
+                        if live(track_id) != (segment, doc):
+                            continue
+                        tf, length = len(positions), lengths.get(field, 0)
+                        scores[track_id] += boost * idfs[key] * tf * (BM25_K1 + 1) / (tf + BM25_K1 * (1 - BM25_B + BM25_B * length / avg_length))
+
+        results = []
+        for track_id, score in scores.iteritems():
+            if track_id in exclude:
+                continue
+            entry = live(track_id)
+            if entry is None:
+                continue
+            segment, doc = entry
+            if sources and not sources.intersection(segment.docs[doc][1]):
+                continue
+            if popularity:
+                # Same as the log2p modifier of Elasticsearch
+                score *= math.log10(max(segment.docs[doc][2], 0) + 2)
+            results.append((track_id, score))
+
+        return len(results), heapq.nlargest(offset + size, results, key=lambda x: x[1])[offset:]
+
+    def _phrase_matches(self, segment, keys):
+        # Returns the documents in which the tokens appear right after each other
+        candidates = None
+        for index, key in enumerate(keys):
+            starts = defaultdict(set)
+            for doc, positions in segment.get_postings(key):
+                if candidates is None or doc in candidates:
+                    starts[doc].update(position - index for position in positions)
+            candidates = starts if candidates is None else dict((doc, candidates[doc] & starts[doc]) for doc in starts if candidates[doc] & starts[doc])
+            if not candidates:
+                break
+        return candidates or {}
+
+    def stats(self):
+        return {'ready': self.ready,
+                'segments': len(self.segments),
+                'tracks': self._num_live()}
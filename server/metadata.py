@@ -28,7 +28,7 @@ class MetadataChecker(object):
         self.logger.info('Checking for metadata')
 
         sources = set()
-        sessions = self.database.get_all_sessions()
+        sessions = yield self.database.deferred.get_all_sessions()
         for session in sessions:
             playlists = session.get('playlists', {})
             for pl_name, pl_dict in playlists.iteritems():
@@ -38,7 +38,7 @@ class MetadataChecker(object):
                     continue
 
                 for track_id in pl_dict['tracks']:
-                    track = self.database.get_track(track_id)
+                    track = yield self.database.deferred.get_track(track_id)
                     if track:
                         sources |= set(track.get('sources', []))
                     else:
@@ -46,7 +46,8 @@ class MetadataChecker(object):
 
         tracks = []
         for source in sources:
-            tracks.extend(self.database.get_tracks_from_source(source))
+            source_tracks = yield self.database.deferred.get_tracks_from_source(source)
+            tracks.extend(source_tracks)
 
         now = int(time.time())
         tracks = [track for track in tracks if now - track.get('musicinfo', {}).get('last_check', 0) >= METADATA_CHECK_INTERVAL]
@@ -82,18 +83,18 @@ class MetadataChecker(object):
             musicinfo['last_check'] = int(time.time())
             track['musicinfo'] = musicinfo
 
-            self.database.set_track_musicinfo(track, musicinfo)
+            yield self.database.deferred.set_track_musicinfo(track, musicinfo)
             if got_musicinfo:
                 self.logger.info('Updated metadata for track %s', track['_id'])
 
                 if add_sources:
                     for artist in musicinfo.get('similar_artists', []):
-                        source_id = self.database.add_source({"data": artist, "type": "artist", "site": "lastfm"})
+                        source_id = yield self.database.deferred.add_source({"data": artist, "type": "artist", "site": "lastfm"})
                         if source_id is not None:
                             self.logger.info('Added Lastfm similar artist source for: %s', artist)
 
                     for user in musicinfo.get('favoriters', []):
-                        source_id = self.database.add_source({"data": user[2], "type": "favorites", "site": "soundcloud"})
+                        source_id = yield self.database.deferred.add_source({"data": user[2], "type": "favorites", "site": "soundcloud"})
                         if source_id is not None:
                             self.logger.info('Added Soundcloud favorites source for: %s', user)
 
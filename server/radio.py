@@ -89,8 +89,23 @@ class BillyRadioFactory(WebSocketServerFactory):
     @inlineCallbacks
     def register(self, peer, user_name, radio_id):
         if radio_id not in self.stations:
-            self.stations[radio_id] = BillyRadioStation(radio_id, self.config, self.database)
-            yield self.stations[radio_id].update_tracks()
+            radio = yield self.database.deferred.get_radio(radio_id)
+            if radio is None:
+                self.logger.warning('Peer %s tried to register for unknown radio %s', peer, radio_id)
+                self.send({'type': 'error', 'radio_id': radio_id, 'message': 'unknown radio'}, [peer])
+                returnValue(None)
+
+            # Another peer may have registered for the same radio while we were looking it up
+            if radio_id not in self.stations:
+                station = BillyRadioStation(radio_id, self.config, self.database, radio['session_id'], radio['playlist_name'])
+                self.stations[radio_id] = station
+                try:
+                    yield station.update_tracks()
+                except Exception as e:
+                    self.logger.error('Failed to start radio %s (reason: %s)', radio_id, e)
+                    self.stations.pop(radio_id, None)
+                    self.send({'type': 'error', 'radio_id': radio_id, 'message': 'cannot start radio'}, [peer])
+                    returnValue(None)
 
         station = self.stations[radio_id]
         peers = station.get_peers()
@@ -120,19 +135,25 @@ class BillyRadioFactory(WebSocketServerFactory):
     def fetch_playlist(self):
         self.logger.info('Checking tracks')
 
-        for radio_id, station in self.stations.iteritems():
-            updated = yield station.update_tracks()
+        # Stations can come and go while we're waiting, so iterate over a copy
+        for radio_id, station in self.stations.items():
+            try:
+                updated = yield station.update_tracks()
+            except Exception as e:
+                # Don't let a single broken station stop the others from updating
+                self.logger.error('Failed to check tracks for radio %s (reason: %s)', radio_id, e)
+                continue
 
             if updated:
                 # Notify everyone
                 self.send_data(radio_id)
                 self.send_status(radio_id)
 
-            self.logger.info('Done checking tracks')
+        self.logger.info('Done checking tracks')
 
 
 class BillyRadioStation(object):
-    def __init__(self, radio_id, config, database):
+    def __init__(self, radio_id, config, database, session_id=None, playlist_name=None):
         self.logger = logging.getLogger(__name__)
 
         self.start_time = 0
@@ -141,10 +162,8 @@ class BillyRadioStation(object):
         self.database = database
         self.listeners = {}
         self.tracks = []
-
-        radio = self.database.get_radio(self.radio_id)
-        self.session_id = radio['session_id']
-        self.playlist_name = radio['playlist_name']
+        self.session_id = session_id
+        self.playlist_name = playlist_name
 
     def register(self, peer, user_name):
         self.listeners[peer] = {'user_id': hashlib.sha1(str(peer)).hexdigest(),
@@ -177,7 +196,12 @@ class BillyRadioStation(object):
     def update_tracks(self):
         self.logger.info('Checking tracks for radio %s', self.radio_id)
 
-        session = self.database.get_session(self.session_id)
+        if self.session_id is None:
+            radio = yield self.database.deferred.get_radio(self.radio_id)
+            self.session_id = radio['session_id']
+            self.playlist_name = radio['playlist_name']
+
+        session = yield self.database.deferred.get_session(self.session_id)
         tracks = session['playlists'][self.playlist_name]['tracks']
         # Only allow youtube tracks for now
         tracks = [track for track in tracks if track['link'].startswith('youtube:')]
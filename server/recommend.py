@@ -0,0 +1,415 @@
+import os
+import json
+import math
+import time
+import heapq
+import logging
+import numpy as np
+import scipy.sparse as sp
+
+from util import BackgroundIndex
+from collections import defaultdict
+from twisted.internet import reactor, defer, threads, task
+
+
+ARTIST_NEIGHBOURS = 50
+ARTIST_SIMILAR_WEIGHT = 1.0
+ARTIST_COOCCURRENCE_WEIGHT = 1.0
+ARTIST_INDEX_REBUILD_INTERVAL = 24 * 3600
+VECTOR_MUSICINFO_FIELDS = ['tags', 'artist_name', 'similar_artists', 'speed', 'acousticelectric', 'vocalinstrumental']
+VECTOR_MAX_RESULTS = 200
+VECTOR_MAX_STALE = 0.25
+VECTOR_SNAPSHOT_INTERVAL = 600
+VECTOR_MERGE_INTERVAL = 5
+VECTOR_MERGE_SIZE = 5000
+VECTOR_RECONCILE_MARGIN = 3600
+
+
+class ArtistIndex(BackgroundIndex):
+    # Keeps track of which artists are similar (according to the track metadata) and which artists
+    # occur together in playlists, so recommendations don't need to be computed from scratch
+
+    def __init__(self):
+        BackgroundIndex.__init__(self)
+        self.logger = logging.getLogger(__name__)
+
+        self.track_artists = {}
+        self.similar = {}
+        self.cooccurring = defaultdict(lambda: defaultdict(int))
+        self.neighbours_cache = {}
+
+        # Changes that come in during a rebuild, so they can be replayed on the new index
+        self.rebuilding = False
+        self.changes = []
+
+    def start(self, database, rebuild_interval=ARTIST_INDEX_REBUILD_INTERVAL):
+        # Co-occurrences of tracks that got their metadata after being playlisted are picked up by the periodic rebuild
+        task.LoopingCall(self.rebuild, database).start(rebuild_interval)
+
+    def rebuild(self, database):
+        # Build a new index in the MongoDB thread pool and swap it in when it's done
+        def build():
+            index = ArtistIndex()
+            query = {'musicinfo.artist_name': {'$exists': True}}
+            projection = {'musicinfo.artist_name': 1, 'musicinfo.similar_artists': 1}
+            for track in database.get_all_tracks(query, projection):
+                index._apply([track])
+            for track_ids in database.get_playlist_track_ids():
+                index.update_membership([(track_ids[:i], track_id, 1) for i, track_id in enumerate(track_ids)])
+            return index
+
+        def swap(index):
+            self.track_artists = index.track_artists
+            self.similar = index.similar
+            self.cooccurring = index.cooccurring
+            self.neighbours_cache = {}
+            self.logger.info('Built artist index (%s artists, %s tracks)', len(self.similar), len(self.track_artists))
+
+            # Replay what came in while we were building, so far it only made it into the old index
+            changes, self.changes = self.changes, []
+            for apply, args in changes:
+                apply(args)
+
+        def finish(_):
+            self.rebuilding = False
+            self.changes = []
+
+        self.rebuilding = True
+        d = self.build_in_background(database.threadpool, build, swap, 'artist index')
+        d.addBoth(finish)
+        return d
+
+    def add_tracks(self, tracks):
+        # Also keeps the tracks in order with the membership changes, which need their artists
+        if self.rebuilding:
+            self.changes.append((self._apply, list(tracks)))
+        BackgroundIndex.add_tracks(self, tracks)
+
+    def _apply(self, tracks):
+        for track in tracks:
+            musicinfo = track.get('musicinfo', {})
+            artist = musicinfo.get('artist_name', None)
+            if not artist:
+                continue
+            self.track_artists[track['_id']] = artist
+
+            # Last.fm lists similar artists from most to least similar
+            similar_artists = [a for a in musicinfo.get('similar_artists', []) if a != artist]
+            similar = dict((a, 1.0 - float(i) / len(similar_artists)) for i, a in enumerate(similar_artists))
+            if similar != self.similar.get(artist, None):
+                self.similar[artist] = similar
+                self.neighbours_cache.pop(artist, None)
+
+    def update_membership(self, changes):
+        # Changes are (track ids already in the playlist, track id, delta) tuples
+        if self.rebuilding:
+            self.changes.append((self._update_membership, list(changes)))
+        self._update_membership(changes)
+
+    def _update_membership(self, changes):
+        for track_ids, track_id, delta in changes:
+            artist = self.track_artists.get(track_id, None)
+            if artist is None:
+                continue
+            for other_track_id in track_ids:
+                other_artist = self.track_artists.get(other_track_id, None)
+                if other_artist is None or other_artist == artist:
+                    continue
+                for a, b in [(artist, other_artist), (other_artist, artist)]:
+                    self.cooccurring[a][b] += delta
+                    if self.cooccurring[a][b] <= 0:
+                        del self.cooccurring[a][b]
+                        if not self.cooccurring[a]:
+                            del self.cooccurring[a]
+                    self.neighbours_cache.pop(a, None)
+
+    def neighbours(self, artist):
+        # Returns the top-k most related artists with a weight between 0 and 1 each
+        if artist not in self.neighbours_cache:
+            weights = dict((a, ARTIST_SIMILAR_WEIGHT * w) for a, w in self.similar.get(artist, {}).iteritems())
+            cooccurring = self.cooccurring.get(artist, {})
+            max_count = float(max(cooccurring.itervalues())) if cooccurring else 0
+            for a, count in cooccurring.iteritems():
+                weights[a] = weights.get(a, 0) + ARTIST_COOCCURRENCE_WEIGHT * count / max_count
+
+            total_weight = ARTIST_SIMILAR_WEIGHT + ARTIST_COOCCURRENCE_WEIGHT
+            self.neighbours_cache[artist] = [(a, w / total_weight) for a, w in heapq.nlargest(ARTIST_NEIGHBOURS, weights.iteritems(), key=lambda x: x[1])]
+        return self.neighbours_cache[artist]
+
+    def top_artists(self, artist_counts, k):
+        # Scores the artists related to the given artists and returns the k best (artist, score) tuples
+        scores = defaultdict(float)
+        for artist, count in artist_counts.iteritems():
+            scores[artist] += count
+            for neighbour, weight in self.neighbours(artist):
+                scores[neighbour] += count * weight
+        return heapq.nlargest(k, scores.iteritems(), key=lambda x: x[1])
+
+    def stats(self):
+        return {'ready': self.ready,
+                'artists': len(self.similar),
+                'tracks': len(self.track_artists)}
+
+
+class VectorIndex(BackgroundIndex):
+    # Keeps every track as a normalized row of a sparse track x feature matrix, so a playlist can be
+    # compared against the whole catalogue with a single matrix-vector product
+
+    def __init__(self, features, path=None):
+        BackgroundIndex.__init__(self)
+        self.logger = logging.getLogger(__name__)
+
+        # Function that returns the (feature, weight) tuples of a track
+        self.features = features
+        self.path = path
+
+        self.columns = {}
+        self.source_columns = {}
+        self.rows = {}
+        self.track_ids = []
+        self.matrix = sp.csr_matrix((0, 0), dtype=np.float32)
+        self.source_matrix = sp.csr_matrix((0, 0), dtype=np.bool_)
+        self.stale = np.zeros(0, dtype=np.bool_)
+        self.buffer = {}
+        self.merging = False
+        self.staled = []
+        self.dirty = False
+
+    def start(self, database, snapshot_interval=VECTOR_SNAPSHOT_INTERVAL, merge_interval=VECTOR_MERGE_INTERVAL):
+        if self.path and os.path.exists(self.path):
+            # If the snapshot can't be loaded (e.g. because it's corrupt), build the index from scratch instead
+            d = self.build_in_background(None, self.load, self._loaded, 'vector index')
+            d.addCallback(lambda snapshot_time: self.reconcile(database, snapshot_time) if snapshot_time is not None else self.rebuild(database))
+        else:
+            self.rebuild(database)
+
+        task.LoopingCall(self.merge).start(merge_interval, now=False)
+        task.LoopingCall(self.snapshot).start(snapshot_interval, now=False)
+        reactor.addSystemEventTrigger('before', 'shutdown', self.snapshot)
+
+    def _projection(self):
+        projection = dict(('musicinfo.' + key, 1) for key in VECTOR_MUSICINFO_FIELDS)
+        projection['sources'] = 1
+        return projection
+
+    def rebuild(self, database):
+        # Build the matrices in the MongoDB thread pool and swap them in when they're done
+        def build():
+            columns, source_columns = {}, {}
+            rows = [self._row(track) for track in database.get_all_tracks({'musicinfo': {'$exists': True}}, self._projection())]
+            matrix, source_matrix, track_ids = self._block(rows, columns, source_columns)
+            return columns, source_columns, matrix, source_matrix, track_ids
+
+        def swap(result):
+            self.columns, self.source_columns, self.matrix, self.source_matrix, self.track_ids = result
+            self.rows = dict((track_id, index) for index, track_id in enumerate(self.track_ids))
+            self.stale = np.zeros(len(self.track_ids), dtype=np.bool_)
+            self.dirty = True
+            self.logger.info('Built vector index (%s tracks, %s features)', len(self.rows), len(self.columns))
+
+        return self.build_in_background(database.threadpool, build, swap, 'vector index')
+
+    def reconcile(self, database, since):
+        # The snapshot misses the tracks that changed after it was saved (e.g. because we crashed), so get them from MongoDB.
+        # The margin covers tracks that were still waiting in the index queue when the snapshot was saved.
+        def build():
+            return list(database.get_all_tracks({'updated': {'$gte': since - VECTOR_RECONCILE_MARGIN}}, self._projection()))
+
+        def apply(tracks):
+            self.add_tracks(tracks)
+            self.logger.info('Reconciled vector index snapshot (%s tracks changed)', len(tracks))
+
+        d = threads.deferToThreadPool(reactor, database.threadpool, build)
+        d.addCallbacks(apply, lambda failure: self.logger.error('Failed to reconcile vector index snapshot (reason: %s)', failure.value))
+        return d
+
+    def load(self):
+        with open(self.path, 'rb') as fp:
+            snapshot = np.load(fp)
+            meta = json.loads(str(snapshot['meta']))
+            shape = (len(meta['track_ids']), len(meta['columns']))
+            matrix = sp.csr_matrix((snapshot['data'], snapshot['indices'], snapshot['indptr']), shape=shape)
+            shape = (len(meta['track_ids']), len(meta['sources']))
+            source_matrix = sp.csr_matrix((np.ones(len(snapshot['source_indices']), dtype=np.bool_),
+                                           snapshot['source_indices'], snapshot['source_indptr']), shape=shape)
+            stale = snapshot['stale']
+        return meta, matrix, source_matrix, stale
+
+    def _loaded(self, result):
+        meta, matrix, source_matrix, stale = result
+        self.columns = dict((column, index) for index, column in enumerate(meta['columns']))
+        self.source_columns = dict((source, index) for index, source in enumerate(meta['sources']))
+        self.track_ids = meta['track_ids']
+        self.rows = dict((track_id, index) for index, track_id in enumerate(self.track_ids) if not stale[index])
+        self.matrix = matrix
+        self.source_matrix = source_matrix
+        self.stale = stale
+        self.logger.info('Loaded vector index (%s tracks, %s features)', len(self.rows), len(self.columns))
+        return meta.get('time', 0)
+
+    def snapshot(self):
+        if not self.path or not self.ready or not self.dirty:
+            return defer.succeed(None)
+        self.dirty = False
+
+        # The matrices are replaced rather than modified, so only the stale flags need to be copied
+        matrix, source_matrix, stale = self.matrix, self.source_matrix, self.stale.copy()
+        meta = json.dumps({'time': time.time(),
+                           'track_ids': list(self.track_ids),
+                           'columns': sorted(self.columns, key=self.columns.get)[:matrix.shape[1]],
+                           'sources': sorted(self.source_columns, key=self.source_columns.get)[:source_matrix.shape[1]]})
+
+        def write():
+            directory = os.path.dirname(self.path)
+            if directory and not os.path.exists(directory):
+                os.makedirs(directory)
+            with open(self.path + '.tmp', 'wb') as fp:
+                np.savez(fp, data=matrix.data, indices=matrix.indices, indptr=matrix.indptr,
+                         source_indices=source_matrix.indices, source_indptr=source_matrix.indptr,
+                         stale=stale, meta=np.array(meta))
+            os.rename(self.path + '.tmp', self.path)
+            self.logger.info('Saved vector index snapshot (%s tracks)', len(self.rows))
+
+        d = threads.deferToThread(write)
+        d.addErrback(lambda failure: self.logger.error('Failed to save vector index snapshot (reason: %s)', failure.value))
+        return d
+
+    def _row(self, track):
+        # Returns the track id with the feature weights and the sources of the track
+        weights = {}
+        for feature, weight in self.features(track):
+            weights[feature] = weights.get(feature, 0) + weight
+        return track['_id'], weights, track.get('sources', [])
+
+    def _apply(self, tracks):
+        # New rows are buffered, since appending to the matrices means copying them
+        for track in tracks:
+            row = self._row(track)
+            if row[0] in self.rows:
+                # Older versions of the track stay in the matrix until the next compaction, but are never recommended
+                self.stale[self.rows.pop(row[0])] = True
+                if self.merging:
+                    self.staled.append(row[0])
+            self.buffer[row[0]] = row
+
+        if len(self.buffer) >= VECTOR_MERGE_SIZE:
+            self.merge()
+
+    def merge(self):
+        # Appends the buffered rows to the matrices (and drops the stale rows once there are too many of them). The
+        # matrices are copied in a thread, the reactor thread only deals with the new rows.
+        if self.merging or not self.buffer or not self.ready:
+            return defer.succeed(None)
+        self.merging = True
+        self.staled = []
+
+        rows, self.buffer = self.buffer.values(), {}
+        block, source_block, track_ids = self._block(rows, self.columns, self.source_columns)
+        matrix, source_matrix, stale, old_track_ids = self.matrix, self.source_matrix, self.stale.copy(), self.track_ids
+        num_columns, num_source_columns = len(self.columns), len(self.source_columns)
+        compact = stale.sum() > (len(stale) + len(track_ids)) * VECTOR_MAX_STALE
+
+        def build():
+            keep, new_track_ids, new_rows = None, None, None
+            new_matrix, new_source_matrix = matrix, source_matrix
+            if compact:
+                keep = np.flatnonzero(~stale)
+                new_matrix, new_source_matrix = new_matrix[keep], new_source_matrix[keep]
+                new_track_ids = [old_track_ids[index] for index in keep]
+                new_rows = dict((track_id, index) for index, track_id in enumerate(new_track_ids))
+            new_matrix = sp.vstack([self._resize(new_matrix, num_columns), block], format='csr')
+            new_source_matrix = sp.vstack([self._resize(new_source_matrix, num_source_columns), source_block], format='csr')
+            return new_matrix, new_source_matrix, keep, new_track_ids, new_rows
+
+        def swap(result):
+            self.matrix, self.source_matrix, keep, new_track_ids, new_rows = result
+            if keep is not None:
+                # Rows that went stale while we were merging need to stay stale
+                self.stale = self.stale[keep]
+                self.track_ids = new_track_ids
+                for track_id in self.staled:
+                    new_rows.pop(track_id, None)
+                self.rows = new_rows
+
+            offset = len(self.track_ids)
+            self.stale = np.concatenate([self.stale, np.zeros(len(track_ids), dtype=np.bool_)])
+            self.track_ids.extend(track_ids)
+            for index, track_id in enumerate(track_ids):
+                if track_id in self.buffer:
+                    # The track changed again while we were merging
+                    self.stale[offset + index] = True
+                else:
+                    self.rows[track_id] = offset + index
+            self.dirty = True
+
+        def failed(failure):
+            self.logger.error('Failed to merge vector index rows (reason: %s)', failure.value)
+            for row in rows:
+                self.buffer.setdefault(row[0], row)
+
+        def done(_):
+            self.merging = False
+            self.staled = []
+
+        d = threads.deferToThread(build)
+        d.addCallbacks(swap, failed)
+        d.addBoth(done)
+        return d
+
+    def _block(self, rows, columns, source_columns):
+        # Turns (track id, weights, sources) rows into CSR matrices, new features and sources get new columns
+        data, indices, indptr = [], [], [0]
+        source_indices, source_indptr = [], [0]
+        track_ids = []
+        for track_id, weights, sources in rows:
+            if not weights:
+                continue
+
+            norm = math.sqrt(sum(weight ** 2 for weight in weights.itervalues()))
+            for feature, weight in weights.iteritems():
+                indices.append(columns.setdefault(feature, len(columns)))
+                data.append(weight / norm)
+            indptr.append(len(indices))
+            for source in sources:
+                source_indices.append(source_columns.setdefault(source, len(source_columns)))
+            source_indptr.append(len(source_indices))
+            track_ids.append(track_id)
+
+        matrix = sp.csr_matrix((np.array(data, dtype=np.float32), np.array(indices, dtype=np.int32), np.array(indptr, dtype=np.int32)),
+                               shape=(len(track_ids), len(columns)))
+        source_matrix = sp.csr_matrix((np.ones(len(source_indices), dtype=np.bool_), np.array(source_indices, dtype=np.int32),
+                                       np.array(source_indptr, dtype=np.int32)), shape=(len(track_ids), len(source_columns)))
+        return matrix, source_matrix, track_ids
+
+    def _resize(self, matrix, num_columns):
+        # Adds empty columns for new features, without copying the matrix
+        return sp.csr_matrix((matrix.data, matrix.indices, matrix.indptr), shape=(matrix.shape[0], num_columns))
+
+    def recommend(self, track_ids, sources=None, k=VECTOR_MAX_RESULTS):
+        # Returns the ids of the k tracks closest to the centroid of the given tracks, or None if we know none of them
+        rows = [self.rows[track_id] for track_id in track_ids if track_id in self.rows]
+        if not rows:
+            return None
+
+        centroid = np.asarray(self.matrix[rows].sum(axis=0)).ravel()
+        scores = self.matrix.dot(centroid)
+        scores[self.stale] = -np.inf
+        scores[rows] = -np.inf
+
+        if sources:
+            # Sources that were only just added have a column, but aren't in the matrix yet
+            source_vector = np.zeros(self.source_matrix.shape[1], dtype=np.float32)
+            source_vector[[self.source_columns[s] for s in sources if self.source_columns.get(s, len(source_vector)) < len(source_vector)]] = 1
+            scores[self.source_matrix.dot(source_vector) == 0] = -np.inf
+
+        k = min(k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [self.track_ids[index] for index in top if scores[index] > 0]
+
+    def stats(self):
+        return {'ready': self.ready,
+                'tracks': len(self.rows),
+                'features': len(self.columns),
+                'stale': int(self.stale.sum()),
+                'buffered': len(self.buffer)}
@@ -1,11 +1,18 @@
 import os
-import copy
 import json
+import time
+import heapq
 import random
+import hashlib
 import logging
 
 from util import *
-from twisted.internet import defer
+from terms import TermIndex
+from autocomplete import Autocomplete
+from localsearch import LocalIndex, tokenize
+from recommend import ArtistIndex, VectorIndex
+from collections import Counter
+from twisted.internet import reactor, defer, task
 from twisted.internet.defer import inlineCallbacks
 
 
@@ -14,9 +21,112 @@ ES_SEARCH_URL = 'http://{host}:{port}/{index}/{type}/_search?size={size}&from={o
 ES_MAPPING_URL = 'http://{host}:{port}/{index}'
 
 BULK_BATCH_SIZE = 1000
+BULK_MAX_CONCURRENCY = 4
+BULK_MAX_RETRIES = 3
+BULK_RETRY_DELAY = 1
+ES_MAX_CONNECTIONS = 16
+SEARCH_CACHE_SIZE = 32 * 1024 * 1024
+SEARCH_CACHE_TTL = 300
+INDEX_QUEUE_FLUSH_SIZE = 1000
+INDEX_QUEUE_FLUSH_INTERVAL = 10
+INDEX_QUEUE_MAX_ATTEMPTS = 10
+INDEX_QUEUE_MAX_BACKOFF = 300
+RECOMMEND_NUM_ARTISTS = 50
+RECOMMEND_MAX_RESULTS = 200
+RECOMMEND_CACHE_SIZE = 16 * 1024 * 1024
+RECOMMEND_CACHE_TTL = 600
+VECTOR_SNAPSHOT_PATH = 'data/recommend.npz'
+LOCAL_INDEX_PATH = 'data/search'
+ALTERNATIVE_SPELLINGS_PATH = 'data/tags_alternative_spellings_formatted.txt'
+FEATURE_ARTIST_WEIGHT = 2.0
+FEATURE_SIMILAR_ARTIST_WEIGHT = 0.5
 CURRENT_DIR = os.path.dirname(os.path.realpath(__file__))
 
 
+class IndexQueue(object):
+    # Sends the tracks that Database queued in its index_queue collection to Elasticsearch, using the latest version of each track
+
+    def __init__(self, database, search, flush_size=INDEX_QUEUE_FLUSH_SIZE, flush_interval=INDEX_QUEUE_FLUSH_INTERVAL, max_attempts=INDEX_QUEUE_MAX_ATTEMPTS):
+        self.logger = logging.getLogger(__name__)
+
+        self.database = database
+        self.search = search
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.max_attempts = max_attempts
+        self.pending = 0
+        self.flushing = False
+        self.backoff = 0
+        self.resume_at = 0
+        self.counters = {'flushes': 0, 'indexed': 0, 'rejected': 0, 'retried': 0, 'unavailable': 0, 'last_flush_latency': 0}
+
+        # Also replays anything that was left in the queue before a restart
+        task.LoopingCall(self.flush).start(flush_interval)
+
+    def add(self, tracks):
+        self.pending += len(tracks)
+        if self.pending >= self.flush_size:
+            self.flush()
+
+    @inlineCallbacks
+    def flush(self):
+        if self.flushing or time.time() < self.resume_at:
+            return
+        self.flushing = True
+        self.pending = 0
+        start = time.time()
+
+        try:
+            while True:
+                entries = yield self.database.deferred.get_index_queue(self.flush_size)
+                if not entries:
+                    self.backoff = 0
+                    break
+
+                tracks = yield self.database.deferred.get_tracks([entry['_id'] for entry in entries])
+                rejected = []
+                errors = []
+                track_ids = yield self.search.index(tracks.values(), new=any(entry.get('new', False) for entry in entries), rejected=rejected, failed=errors)
+
+                # Tracks that no longer exist or that Elasticsearch will never accept are dropped from the queue. Tracks
+                # that Elasticsearch failed to index go to the back of the queue, until they have failed too often.
+                done = set(track_ids) | set(rejected) | set(entry['_id'] for entry in entries if entry['_id'] not in tracks)
+                yield self.database.deferred.remove_from_index_queue([entry for entry in entries if entry['_id'] in done])
+                errors = set(errors) - done
+                failed = [entry for entry in entries if entry['_id'] in errors]
+                yield self.database.deferred.retry_index_queue(failed, self.max_attempts)
+                self.counters['indexed'] += len(track_ids)
+                self.counters['rejected'] += len(rejected)
+                self.counters['retried'] += len(failed)
+
+                # Whatever is left never got an answer from Elasticsearch, so it stays in the queue without counting as
+                # an attempt, and we wait a while before trying again
+                unavailable = len(entries) - len(done) - len(failed)
+                if unavailable:
+                    self.counters['unavailable'] += unavailable
+                    self.back_off()
+                    break
+                self.backoff = 0
+
+                if len(entries) < self.flush_size or len(done) < len(entries):
+                    break
+        except Exception as e:
+            self.logger.error('Failed to flush the index queue (reason: %s)', e)
+            self.back_off()
+        finally:
+            self.flushing = False
+            self.counters['flushes'] += 1
+            self.counters['last_flush_latency'] = time.time() - start
+
+    def back_off(self):
+        self.backoff = min(max(self.backoff * 2, self.flush_interval), INDEX_QUEUE_MAX_BACKOFF)
+        self.resume_at = time.time() + self.backoff
+        self.logger.warning('Pausing the index queue for %s seconds', self.backoff)
+
+    def stats(self):
+        return dict(self.counters, pending=self.pending, backoff=self.backoff)
+
+
 class Search(object):
 
     def __init__(self, database, config, alternative_spelling_dict={}):
@@ -29,66 +139,249 @@ class Search(object):
         self.index_ready = False
         self.alternative_spelling_dict = alternative_spelling_dict
 
+        # The local index can either replace Elasticsearch, or take over whenever Elasticsearch fails
+        self.backend = self.config.get('search', 'backend') if self.config.has_option('search', 'backend') else 'elasticsearch'
+        self.fallback = self.config.getboolean('search', 'fallback') if self.config.has_option('search', 'fallback') else False
+        self.local = None
+
+        if self.config.has_option('search', 'alternative_spellings'):
+            self.expander = QueryExpander(os.path.join(CURRENT_DIR, self.config.get('search', 'alternative_spellings')))
+        else:
+            self.expander = QueryExpander(os.path.join(CURRENT_DIR, ALTERNATIVE_SPELLINGS_PATH))
+
+        # All Elasticsearch requests share their own pool of persistent connections
+        get_pool('elasticsearch', max_per_host=ES_MAX_CONNECTIONS)
+
+        # Search results are cached per index version, which changes whenever the index might give different results
+        self.cache = LRUCache(SEARCH_CACHE_SIZE, sizeof=lambda results: len(json.dumps(results)), ttl=SEARCH_CACHE_TTL)
+        self.cache_version = 0
+        self.cached_ids = set()
+        self.inflight = {}
+
+        # Recommendations are cached per playlist fingerprint, until the metadata of one of the playlist's tracks changes
+        self.recommend_cache = LRUCache(RECOMMEND_CACHE_SIZE, sizeof=lambda entry: len(json.dumps(entry)), ttl=RECOMMEND_CACHE_TTL)
+        self.recommend_inflight = {}
+
+        self.index_queue = None
+        self.artists = ArtistIndex()
+        self.vectors = None
+        self.terms = TermIndex(lambda track: getIndexTerms(track, self.alternative_spelling_dict))
+        self.autocomplete = Autocomplete()
+
+    def start_index_queue(self):
+        self.index_queue = IndexQueue(self.database, self)
+
+    def start_artist_index(self):
+        self.artists.start(self.database)
+
+    def start_local_index(self):
+        if self.backend != 'local' and not self.fallback:
+            return
+        if self.config.has_option('search', 'local_path'):
+            path = os.path.join(CURRENT_DIR, self.config.get('search', 'local_path'))
+        else:
+            path = os.path.join(CURRENT_DIR, LOCAL_INDEX_PATH)
+        self.local = LocalIndex(path, lambda track: getIndexTerms(track, self.alternative_spelling_dict))
+        self.local.start(self.database)
+
+    def start_term_index(self):
+        self.terms.start(self.database)
+
+    def start_autocomplete(self):
+        self.autocomplete.start(self.database)
+
+    def start_vector_index(self):
+        if self.config.has_option('recommend', 'snapshot'):
+            path = os.path.join(CURRENT_DIR, self.config.get('recommend', 'snapshot'))
+        else:
+            path = os.path.join(CURRENT_DIR, VECTOR_SNAPSHOT_PATH)
+        self.vectors = VectorIndex(lambda track: getFeatureTerms(track, self.alternative_spelling_dict), path)
+        self.vectors.start(self.database)
+
     @inlineCallbacks
     def create(self):
-        with open(os.path.join(CURRENT_DIR, 'es_track_mapping.json'), 'rb') as fp:
-            mapping = fp.read()
-        content = {'settings': {'number_of_shards' : 1},
-                   'mappings' : json.loads(mapping)}
-        url = ES_MAPPING_URL.format(host=self.host, port=self.port, index=self.database.db.name)
-        response = yield put_request(url, data=json.dumps(content))
-        if response.json.get('acknowledged', False):
-            self.logger.info('Created index %s', self.database.db.name)
+        # We always use the index through an alias named after the database, so that
+        # tools/rebuild_index.py can swap in a new version of the index without downtime
+        alias = self.database.db.name
+        response = yield get_request(ES_MAPPING_URL.format(host=self.host, port=self.port, index=alias), pool='elasticsearch')
+        if response.status_code == 200:
             self.index_ready = True
-        elif response.json.get('error', {}).get('type', None) == 'index_already_exists_exception':
+            return
+
+        index = '%s_%d' % (alias, int(time.time()))
+        response = yield self.create_index(index, aliases=[alias])
+        if response.json.get('acknowledged', False):
+            self.logger.info('Created index %s (alias %s)', index, alias)
             self.index_ready = True
         else:
-            self.logger.info('Failed to create index %s', self.database.db.name)
+            self.logger.info('Failed to create index %s', index)
+
+    def create_index(self, index, aliases=None, settings=None):
+        with open(os.path.join(CURRENT_DIR, 'es_track_mapping.json'), 'rb') as fp:
+            mapping = fp.read()
+        content = {'settings': dict({'number_of_shards' : 1}, **(settings or {})),
+                   'mappings' : json.loads(mapping)}
+        if aliases:
+            content['aliases'] = dict((alias, {}) for alias in aliases)
+        url = ES_MAPPING_URL.format(host=self.host, port=self.port, index=index)
+        return put_request(url, data=json.dumps(content), pool='elasticsearch')
+
+    def bulk(self, tracks, op, index=None, rejected=None, failed=None):
+        # Send the batches with a bounded number of concurrent bulk requests
+        # Returns the ids of the tracks that made it into the index (by default the alias), the ids of the tracks
+        # that failed without any point in retrying (e.g. mapping errors) are added to rejected, and the ids of the
+        # tracks that Elasticsearch still failed to index after retrying are added to failed
+        index = index or self.database.db.name
+        track_ids = []
+        rejected = rejected if rejected is not None else []
+        failed = failed if failed is not None else []
+        batches = (tracks[i:i+BULK_BATCH_SIZE] for i in xrange(0, len(tracks), BULK_BATCH_SIZE))
+        work = (self._bulk_batch(batch, op, index, rejected, failed).addCallback(track_ids.extend) for batch in batches)
+
+        coop = task.Cooperator()
+        deferreds = [coop.coiterate(work) for _ in xrange(BULK_MAX_CONCURRENCY)]
+        d = defer.DeferredList(deferreds)
+        d.addCallback(lambda _: track_ids)
+        return d
 
     @inlineCallbacks
-    def _bulk(self, tracks, op):
-        url = ES_BULK_URL.format(host=self.host, port=self.port, index=self.database.db.name)
-        counter = 0
-        for index in xrange(0, len(tracks), BULK_BATCH_SIZE):
-            batch = tracks[index:index+BULK_BATCH_SIZE]
-            data = ''
-            for track in batch:
-                track = copy.deepcopy(track)
-                data += json.dumps({op: {'_index': self.database.db.name, '_type': 'track', '_id': track.pop('_id')}}) + '\n'
-                if 'musicinfo' in track and 'listeners' in track['musicinfo']:
-                    track['musicinfo']['listeners'] = [{'ts':ts, 'count':count} for ts, count in track['musicinfo']['listeners'].items()]
-                if 'musicinfo' in track and 'playcount' in track['musicinfo']:
-                    track['musicinfo']['playcount'] = [{'ts':ts, 'count':count} for ts, count in track['musicinfo']['playcount'].items()]
+    def _bulk_batch(self, tracks, op, index, rejected, failed):
+        url = ES_BULK_URL.format(host=self.host, port=self.port, index=index)
+        track_ids = []
+        for attempt in xrange(BULK_MAX_RETRIES + 1):
+            if attempt > 0:
+                yield task.deferLater(reactor, BULK_RETRY_DELAY * 2 ** (attempt - 1), lambda: None)
+
+            data = ''.join(self._bulk_lines(tracks, op, index))
+            response = yield post_request(url, data=data, pool='elasticsearch')
+            try:
+                items = response.json.get('items', None)
+            except ValueError:
+                items = None
+
+            # Retry the whole batch if the request failed, otherwise only the rejected items
+            retry = tracks if items is None else []
+            for track, item in zip(tracks, items or []):
+                status = item.get(op, {}).get('status', None)
+                if status in [200, 201]:
+                    track_ids.append(track['_id'])
+                elif status == 429 or status >= 500:
+                    retry.append(track)
+                else:
+                    self.logger.error('Elasticsearch rejected track %s (reason: %s)', track['_id'], json.dumps(item.get(op, {}).get('error')))
+                    rejected.append(track['_id'])
+
+            if not retry:
+                break
+            tracks = retry
+        else:
+            self.logger.error('Failed to %s %s record(s) after %s attempts', op, len(tracks), BULK_MAX_RETRIES + 1)
+            # Only report the tracks that Elasticsearch answered for, not the ones that never got through
+            if items is not None:
+                failed.extend(track['_id'] for track in tracks)
+
+        defer.returnValue(track_ids)
+
+    def _bulk_lines(self, tracks, op, index):
+        for track in tracks:
+            # Copy only what we change, instead of deep copying the whole track
+            track = dict(track)
+            yield json.dumps({op: {'_index': index, '_type': 'track', '_id': track.pop('_id')}}) + '\n'
+            if 'musicinfo' in track and ('listeners' in track['musicinfo'] or 'playcount' in track['musicinfo']):
+                track['musicinfo'] = dict(track['musicinfo'])
+                for key in ['listeners', 'playcount']:
+                    if key in track['musicinfo']:
+                        track['musicinfo'][key] = [{'ts':ts, 'count':count} for ts, count in track['musicinfo'][key].items()]
+            if 'sources' in track:
                 track['sources'] = [{'id':source} for source in track['sources']]
-                if op == 'create':
-                    data += json.dumps(track) + '\n'
-                elif op == 'update':
-                    data += json.dumps({'doc': track}) + '\n'
-            response = yield post_request(url, data=data)
-            for log in response.json.get('items', []):
-                if log.get(op, {}).get('status', None) in [200, 201]:
-                    counter += 1
-        defer.returnValue(counter)
+            if track.get('stats', {}).get('playlisted', 0) < 0:
+                # Elasticsearch rejects the log of a negative popularity
+                track['stats'] = dict(track['stats'], playlisted=0)
+            if op in ['create', 'index']:
+                yield json.dumps(track) + '\n'
+            elif op == 'update':
+                yield json.dumps({'doc': track}) + '\n'
 
     @inlineCallbacks
-    def index(self, tracks):
-        # Make sure the index exists
-        if not self.index_ready:
-            self.create()
+    def index(self, tracks, new=True, rejected=None, failed=None):
+        start = time.time()
+        if self.local is not None:
+            self.local.add_tracks(tracks)
 
-        count = yield self._bulk(tracks, 'create')
-        self.logger.info('Indexed %s record(s)', count)
+        if self.backend == 'local':
+            track_ids = [track['_id'] for track in tracks]
+        else:
+            # Make sure the index exists
+            if not self.index_ready:
+                yield self.create()
+            track_ids = yield self.bulk(tracks, 'index', rejected=rejected, failed=failed)
+        self.artists.add_tracks(tracks)
+        self.terms.add_tracks(tracks)
+        self.autocomplete.add_tracks(tracks)
+        if self.vectors is not None:
+            self.vectors.add_tracks(tracks)
+        self.logger.info('Indexed %s record(s) (%.0f records/s)', len(track_ids), len(track_ids) / max(time.time() - start, 0.001))
+
+        # New tracks may show up in any search
+        if new:
+            self.invalidate_cache()
+        else:
+            self.invalidate_tracks(track_ids)
+        defer.returnValue(track_ids)
 
-    @inlineCallbacks
-    def update(self, tracks):
-        count = yield self._bulk(tracks, 'update')
-        self.logger.debug('Updated %s record(s)', count)
+    def invalidate_cache(self):
+        self.cache_version += 1
+        self.cached_ids = set()
+
+    def invalidate_tracks(self, track_ids):
+        # Only invalidate the cache if it contains one of the tracks
+        if any(track_id in self.cached_ids for track_id in track_ids):
+            self.invalidate_cache()
 
-    @inlineCallbacks
     def search(self, query, field='title', sources=None, max_results=200):
+        d = self.search_page(query, field, sources, size=max_results)
+        d.addCallback(lambda page: page['results'])
+        return d
+
+    def search_page(self, query, field='title', sources=None, offset=0, size=200, sort='relevance'):
+        # Returns a dict with the requested page of results and the total number of hits
+        key = (self.cache_version, ' '.join(query.split()), field, tuple(sorted(sources)) if sources else None, offset, size, sort)
+
+        page = self.cache.get(key)
+        if page is not None:
+            return defer.succeed(dict(page, results=list(page['results'])))
+
+        # Identical queries that are already running share the same Elasticsearch request
+        d = defer.Deferred()
+        if key in self.inflight:
+            self.inflight[key].append(d)
+            return d
+        self.inflight[key] = [d]
+
+        def on_results(page):
+            # Don't cache degraded results, so we go back to Elasticsearch as soon as it recovers
+            if key[0] == self.cache_version and not page.get('degraded', False):
+                self.cache.set(key, page)
+                self.cached_ids.update(result['_id'] for result in page['results'])
+            for waiting in self.inflight.pop(key):
+                waiting.callback(dict(page, results=list(page['results'])))
+
+        def on_error(failure):
+            for waiting in self.inflight.pop(key):
+                waiting.errback(failure)
+
+        self._search(query, field, sources, offset, size, sort).addCallbacks(on_results, on_error)
+        return d
+
+    @inlineCallbacks
+    def _search(self, query, field='title', sources=None, offset=0, size=200, sort='relevance'):
         self.logger.info('Searching for query %s', query)
+        query = self.expander.expand(query)
 
-        url = ES_SEARCH_URL.format(host=self.host, port=self.port, index=self.database.db.name, type='track', size=max_results, offset=0)
+        if self.backend == 'local':
+            defer.returnValue((yield self._search_local(query, field, sources, offset=offset, size=size, sort=sort)))
+
+        url = ES_SEARCH_URL.format(host=self.host, port=self.port, index=self.database.db.name, type='track', size=size, offset=offset)
 
         query_dict = build_bool_query('must', {})
         query_dict['query']['bool']['must'] = [build_query(query, field)['query']]
@@ -98,68 +391,219 @@ class Search(object):
             nested_query = build_bool_query('must', {'sources.id': ' '.join(sources)}, nested_path='sources')
             query_dict['query']['bool']['must'].append(nested_query)
 
-        response = yield post_request(url, data=json.dumps(query_dict))
+        if sort == 'popularity':
+            # Boost the relevance score by the number of playlists a track is in
+            query_dict = build_popularity_query(query_dict, 'stats.playlisted')
+
+        response = yield post_request(url, data=json.dumps(query_dict), pool='elasticsearch')
+
+        hits = self._get_hits(response)
+        if hits is None:
+            if self.local is not None and self.local.ready:
+                self.logger.warning('Elasticsearch failed, searching the local index instead')
+                page = yield self._search_local(query, field, sources, offset=offset, size=size, sort=sort)
+                defer.returnValue(dict(page, degraded=True))
+            self.logger.warning('Elasticsearch failed, returning no results')
+            defer.returnValue({'total': 0, 'results': [], 'degraded': True})
 
         results = []
-        for hit in response.json.get('hits', {}).get('hits', []):
+        for hit in hits.get('hits', []):
             result = hit['_source']
             result['_id'] = hit['_id']
             results.append(result)
 
-        defer.returnValue(results)
+        defer.returnValue({'total': hits.get('total', 0), 'results': results})
+
+    def _get_hits(self, response):
+        # Returns None if the request failed
+        try:
+            return response.json['hits'] if response.status_code == 200 else None
+        except (ValueError, KeyError):
+            return None
+
+    @inlineCallbacks
+    def _search_local(self, query, field='title', sources=None, exclude=None, offset=0, size=200, sort='relevance'):
+        total, hits = yield self.local.search(query, field, sources, exclude, offset, size, popularity=(sort == 'popularity'))
+        track_ids = [track_id for track_id, _ in hits]
+        tracks = yield self.database.deferred.get_tracks(track_ids)
+        defer.returnValue({'total': total, 'results': [tracks[track_id] for track_id in track_ids if track_id in tracks]})
+
+    def recommend_cached(self, playlist):
+        # Same as recommend, but shares the results between all requests for the same version of the playlist
+        key = playlist_fingerprint(playlist)
+        copy = lambda results: list(results) if results is not None else None
+
+        # The function counters change whenever a track gets playlisted, so they're not part of the metadata
+        musicinfo = [dict((k, v) for k, v in track.get('musicinfo', {}).iteritems() if k != 'functions')
+                     for track in sorted((track for track in playlist['tracks'] if track), key=lambda track: track['_id'])]
+        digest = hashlib.sha1(json.dumps(musicinfo, sort_keys=True)).hexdigest()
+
+        entry = self.recommend_cache.get(key)
+        if entry is not None:
+            results, entry_digest = entry
+            if entry_digest == digest:
+                return defer.succeed(copy(results))
+            self.recommend_cache.pop(key)
+
+        d = defer.Deferred()
+        if key in self.recommend_inflight:
+            self.recommend_inflight[key].append(d)
+            return d
+        self.recommend_inflight[key] = [d]
+
+        def on_results(results):
+            self.recommend_cache.set(key, (results, digest))
+            for waiting in self.recommend_inflight.pop(key):
+                waiting.callback(copy(results))
+
+        def on_error(failure):
+            for waiting in self.recommend_inflight.pop(key):
+                waiting.errback(failure)
+
+        self.recommend(playlist).addCallbacks(on_results, on_error)
+        return d
 
     @inlineCallbacks
     def recommend(self, playlist):
-        song_set = playlist['tracks']
+        song_set = [song for song in playlist['tracks'] if song]
 
         if len(song_set) > 0:
-            song_set_ids = [song['_id'] for song in song_set]
-
             sources = set()
             artists = {}
-            for track in playlist['tracks']:
-                for source in track['sources']:
-                    sources.add(source)
-                if 'artist_name' in track.get('musicinfo', {}):
-                    artist_name = track['musicinfo']['artist_name']
-                    artists[artist_name] = artists.get(artist_name, 0) + 1
-                for artist_name in track.get('musicinfo', {}).get('similar_artists', []):
+            for track in song_set:
+                sources.update(track['sources'])
+                artist_name = track.get('musicinfo', {}).get('artist_name', None)
+                if artist_name:
                     artists[artist_name] = artists.get(artist_name, 0) + 1
 
-            # Build the query using the top-100 most frequently seen artists
-            query = ' '.join(['"%s"^%d' % t for t in sorted(artists.items(), key=lambda x: x[1])[:100]])
-            search_results = yield self.search(query, sources=sources)
-
-            filtered_search_results = []
-            for search_result in search_results:
-                if not search_result['_id'] in song_set_ids:
-                    filtered_search_results.append(search_result)
-
-            if len(filtered_search_results) > 0:
-                defer.returnValue(filtered_search_results)
+            # The vector index doesn't need Elasticsearch, only MongoDB (or the track cache) for the track details
+            if self.vectors is not None and self.vectors.ready:
+                track_ids = self.vectors.recommend([song['_id'] for song in song_set], sources)
+                if track_ids:
+                    tracks = yield self.database.deferred.get_tracks(track_ids)
+                    defer.returnValue([tracks[track_id] for track_id in track_ids if track_id in tracks])
+
+            # Related artists come from the artist index, Elasticsearch only needs to fetch their tracks
+            top_artists = self.artists.top_artists(artists, RECOMMEND_NUM_ARTISTS)
+            if top_artists:
+                search_results = yield self._search_artists(top_artists, sources, [song['_id'] for song in song_set])
+                if len(search_results) > 0:
+                    defer.returnValue(search_results)
         else:
             # Return recommendations based on playlist name + description
             query = playlist['name'] + ' ' + playlist['description']
             self.logger.info('Querying dataset for "%s"', query)
             defer.returnValue((yield self.search(query)))
 
+    @inlineCallbacks
+    def _search_artists(self, artists, sources, exclude, size=RECOMMEND_MAX_RESULTS):
+        # Searches for tracks by any of the (artist, score) tuples, while skipping the excluded tracks
+        max_score = float(artists[0][1])
+        if self.backend == 'local':
+            defer.returnValue((yield self._search_artists_local(artists, sources, exclude, size)))
+
+        url = ES_SEARCH_URL.format(host=self.host, port=self.port, index=self.database.db.name, type='track', size=size, offset=0)
+
+        should = [{'multi_match': {'query': artist, 'type': 'phrase', 'fields': ['title', 'musicinfo.artist_name'],
+                                   'boost': score / max_score}} for artist, score in artists]
+        query_dict = {'query': {'bool': {'should': should,
+                                         'minimum_should_match': 1,
+                                         'must_not': [{'ids': {'values': exclude}}]}}}
+
+        if sources:
+            nested_query = build_bool_query('must', {'sources.id': ' '.join(sources)}, nested_path='sources')
+            query_dict['query']['bool']['must'] = [nested_query]
+
+        response = yield post_request(url, data=json.dumps(query_dict), pool='elasticsearch')
+
+        hits = self._get_hits(response)
+        if hits is None:
+            if self.local is not None and self.local.ready:
+                self.logger.warning('Elasticsearch failed, searching the local index instead')
+                defer.returnValue((yield self._search_artists_local(artists, sources, exclude, size)))
+            hits = {}
+
+        results = []
+        for hit in hits.get('hits', []):
+            result = hit['_source']
+            result['_id'] = hit['_id']
+            results.append(result)
+        defer.returnValue(results)
+
+    def _search_artists_local(self, artists, sources, exclude, size=RECOMMEND_MAX_RESULTS):
+        # Same query as we used to send to Elasticsearch, with a boosted phrase per artist
+        max_score = float(artists[0][1])
+        query = ' '.join(u'"%s"^%.3f' % (artist.replace('"', ' '), score / max_score) for artist, score in artists)
+        d = self._search_local(query, '_all', sources, exclude, size=size)
+        d.addCallback(lambda page: page['results'])
+        return d
+
+
+class QueryExpander(object):
+    # Adds the alternative spellings of the tags in a query to the query. The spelling table is only compiled
+    # when the first query comes in, into a dict that maps every spelling to all other spellings of the same tag.
+
+    def __init__(self, path, delimiter=';'):
+        self.logger = logging.getLogger(__name__)
+        self.path = path
+        self.delimiter = delimiter
+        self.spellings = None
+        self.max_length = 0
+
+    def compile(self):
+        spellings = {}
+        if os.path.exists(self.path):
+            for tag, alternatives in getAlternativeSpellingDict(self.path, self.delimiter).iteritems():
+                group = [spelling.decode('utf-8', 'replace').strip() for spelling in [tag] + alternatives if spelling.strip()]
+                for spelling in group:
+                    tokens = tuple(tokenize(spelling))
+                    if tokens:
+                        spellings.setdefault(tokens, set()).update(s for s in group if tuple(tokenize(s)) != tokens)
+        else:
+            self.logger.warning('Cannot find alternative spellings file %s', self.path)
+
+        self.spellings = dict((tokens, tuple(alternatives)) for tokens, alternatives in spellings.iteritems() if alternatives)
+        self.max_length = max(len(tokens) for tokens in self.spellings) if self.spellings else 0
+
+    def expand(self, query):
+        # Searches use OR by default, so appending the spellings as phrases makes the query match any of them
+        if self.spellings is None:
+            self.compile()
+
+        if not isinstance(query, unicode):
+            query = query.decode('utf-8')
+
+        tokens = tokenize(query)
+        alternatives = []
+        index = 0
+        while index < len(tokens):
+            # Prefer the longest spelling that matches at this position
+            for length in xrange(min(self.max_length, len(tokens) - index), 0, -1):
+                found = self.spellings.get(tuple(tokens[index:index + length]))
+                if found:
+                    alternatives.extend(a for a in found if a not in alternatives)
+                    index += length
+                    break
+            else:
+                index += 1
+
+        if not alternatives:
+            return query
+        return query + u' ' + u' '.join(u'"%s"' % alternative.replace('"', ' ') for alternative in alternatives)
+
 
 def getFrequentTerms(music_json_data, num_suggestions=20, exclude_terms=[''], alternative_spelling_dict={}):
     # Suggest frequently occurring metadata info in a given set of JSON results
 
-    all_tags = []
+    counts = Counter()
 
     for song in music_json_data:
-        all_tags.extend(getIndexTerms(song, alternative_spelling_dict))
+        counts.update(getIndexTerms(song, alternative_spelling_dict))
 
-    frequencies = []
-    for tag in set(all_tags):
-        if not tag in exclude_terms:
-          frequencies.append((tag, all_tags.count(tag)))
+    for tag in exclude_terms:
+        counts.pop(tag, None)
 
-    sorted_frequencies = sorted(frequencies, key=lambda x : x[1], reverse=True)
-
-    top_n = sorted_frequencies[0:num_suggestions]
+    top_n = heapq.nlargest(num_suggestions, counts.iteritems(), key=lambda x : x[1])
 
     return [tuple_item[0] for tuple_item in top_n]
 
@@ -175,7 +619,8 @@ def getIndexTerms(song, alternative_spelling_dict):
     index_terms.append(getUnicodeString(music_info.get("acousticelectric", "")))
     index_terms.append(getUnicodeString(music_info.get("vocalinstrumental", "")))
 
-    index_terms.extend(expandSpeedTerms(music_info.get("speed", "")))
+    if music_info.get("speed"):
+        index_terms.extend(expandSpeedTerms(music_info["speed"]))
     index_terms.extend(getCombinedTags(song, alternative_spelling_dict))
 
     index_terms = [term.encode('utf-8') for term in index_terms]
@@ -183,6 +628,27 @@ def getIndexTerms(song, alternative_spelling_dict):
     return filter(None, index_terms)
 
 
+def getFeatureTerms(song, alternative_spelling_dict={}):
+    # Weighted features of a song for the recommendation matrix, based on the same musicinfo fields as getIndexTerms
+    music_info = song.get("musicinfo", {})
+
+    features = [(u'tag:' + tag.lower(), 1.0) for tag in getCombinedTags(song, alternative_spelling_dict)]
+
+    for key in ["acousticelectric", "vocalinstrumental"]:
+        if music_info.get(key):
+            features.append((key + u':' + getUnicodeString(music_info[key]), 1.0))
+
+    if music_info.get("speed"):
+        features.extend((u'speed:' + getUnicodeString(term), 1.0) for term in expandSpeedTerms(music_info["speed"]))
+
+    if music_info.get("artist_name"):
+        features.append((u'artist:' + getUnicodeString(music_info["artist_name"]).lower(), FEATURE_ARTIST_WEIGHT))
+    for artist_name in music_info.get("similar_artists", []):
+        features.append((u'artist:' + getUnicodeString(artist_name).lower(), FEATURE_SIMILAR_ARTIST_WEIGHT))
+
+    return features
+
+
 def getUnicodeString(input):
     if isinstance(input, unicode):
         return input
@@ -203,8 +669,9 @@ def expandSpeedTerms(speed_qualifier):
 def getCombinedTags(song_json_data, alternative_spelling_dict={}):
     combined_tags = []
 
+    # Tags are grouped by category (e.g. genres, instruments, vartags)
     music_info = song_json_data.get('musicinfo', {})
-    for category, tags in music_info.iteritems():
+    for category, tags in music_info.get('tags', {}).iteritems():
         for tag in tags:
             combined_tags.extend(expandAlternativeSpellings(getUnicodeString(tag), alternative_spelling_dict))
 
@@ -3,6 +3,7 @@ import os
 import sys
 import json
 import time
+import base64
 import argparse
 import ConfigParser
 import logging
@@ -14,13 +15,19 @@ from twisted.web.resource import Resource
 from twisted.internet import defer, reactor, ssl
 from twisted.internet.defer import inlineCallbacks
 from twisted.web.static import File
+from twisted.internet.interfaces import IPushProducer
+from zope.interface import implementer
 
 from radio import *
 from search import Search
 from database import Database
+from waveforms import *
 from pymongo import MongoClient
 
 CURRENT_DIR = os.path.dirname(os.path.realpath(__file__))
+CLICKLOG_PAGE_SIZE = 1000
+SUGGEST_LIMIT = 20
+AUTOCOMPLETE_LIMIT = 10
 
 
 def json_out(f):
@@ -40,6 +47,8 @@ class APIResource(Resource):
         self.putChild('playlists', PlaylistsHandler(*args))
         self.putChild('tracks', TracksHandler(*args))
         self.putChild('recommend', RecommendHandler(*args))
+        self.putChild('suggest', SuggestHandler(*args))
+        self.putChild('autocomplete', AutocompleteHandler(*args))
         self.putChild('clicklog', ClicklogHandler(*args))
         self.putChild('waveform', WaveformHandler(*args))
         self.putChild('info', InfoHandler(*args))
@@ -62,78 +71,93 @@ class BaseHandler(Resource):
         request.responseHeaders.addRawHeader('content-type', 'application/json')
         # CORS headers
         request.responseHeaders.addRawHeader('Access-Control-Allow-Origin', '*')
-        request.responseHeaders.addRawHeader('Access-Control-Allow-Methods', 'GET, POST, OPTIONS')
+        request.responseHeaders.addRawHeader('Access-Control-Allow-Methods', 'GET, POST, PATCH, OPTIONS')
         request.responseHeaders.addRawHeader("Access-Control-Allow-Headers", "Authorization,X-Auth-Token,Content-Type,Accept")
+        request.responseHeaders.addRawHeader('Access-Control-Expose-Headers', 'X-Session-Version')
 
     @json_out
     def render_OPTIONS(self, request):
         return {}
 
-    def render_GET(self, request):
+    def render_deferred(self, request, process):
         def finish_req(res, request):
-            request.write(json.dumps(res))
+            # Streaming handlers finish the request themselves
+            if res != server.NOT_DONE_YET:
+                request.write(json.dumps(res))
+                if not request.finished:
+                    request.finish()
+
+        def on_error(failure, request):
+            logging.getLogger(__name__).error('Failed to handle %s %s (reason: %s)', request.method, request.uri, failure.getTraceback())
             if not request.finished:
+                if not request.startedWriting:
+                    request.write(json.dumps(self.error(request, 'internal server error', 500)))
                 request.finish()
 
         self.add_response_headers(request)
-        d = self._process_GET(request)
+        d = defer.maybeDeferred(process, request)
         d.addCallback(finish_req, request)
+        d.addErrback(on_error, request)
         return server.NOT_DONE_YET
 
+    def render_GET(self, request):
+        return self.render_deferred(request, self._process_GET)
+
     @inlineCallbacks
     def _process_GET(self, request):
         defer.returnValue(self.error(request, 'Method not allowed', 405))
 
     def render_POST(self, request):
-        def finish_req(res, request):
-            request.write(json.dumps(res))
-            if not request.finished:
-                request.finish()
-
-        self.add_response_headers(request)
-        d = self._process_POST(request)
-        d.addCallback(finish_req, request)
-        return server.NOT_DONE_YET
+        return self.render_deferred(request, self._process_POST)
 
     @inlineCallbacks
     def _process_POST(self, request):
         defer.returnValue(self.error(request, 'Method not allowed', 405))
 
+    def render_PATCH(self, request):
+        return self.render_deferred(request, self._process_PATCH)
+
+    @inlineCallbacks
+    def _process_PATCH(self, request):
+        defer.returnValue(self.error(request, 'Method not allowed', 405))
+
 
 class SessionHandler(BaseHandler):
 
-    @json_out
-    def render_GET(self, request):
-        token = self.database.create_session()
-        return {'token': token}
+    @inlineCallbacks
+    def _process_GET(self, request):
+        token = yield self.database.deferred.create_session()
+        defer.returnValue({'token': token})
 
 
 class PlaylistsHandler(BaseHandler):
 
-    @json_out
-    def render_GET(self, request):
+    @inlineCallbacks
+    def _process_GET(self, request):
         token = request.args['token'][0] if 'token' in request.args else None
         if token:
-            session = self.database.get_session(token)
+            session = yield self.database.deferred.get_session(token)
 
             if session is None:
-                return self.error(request, 'cannot find session', 404)
+                defer.returnValue(self.error(request, 'cannot find session', 404))
 
             playlists = session['playlists']
 
             for playlist_name, playlist in playlists.iteritems():
-                radio = self.database.find_radio(token, playlist_name)
+                radio = yield self.database.deferred.find_radio(token, playlist_name)
                 if radio is not None:
                     playlist['radio_id'] = radio['_id']
 
-            return playlists
+            request.responseHeaders.addRawHeader('X-Session-Version', str(session.get('version', 0)))
+            defer.returnValue(playlists)
 
-    @json_out
-    def render_POST(self, request):
+    @inlineCallbacks
+    def _process_POST(self, request):
         token = request.args['token'][0] if 'token' in request.args else None
-        session = self.database.get_session(token)
+        # Use the track ids, like the new playlists, so tracks that no longer exist are still compared correctly
+        session = yield self.database.deferred.get_session(token, resolve_tracks=False)
         if session is None:
-            return self.error(request, 'cannot find session', 404)
+            defer.returnValue(self.error(request, 'cannot find session', 404))
 
         body = request.content.read()
 
@@ -141,55 +165,229 @@ class PlaylistsHandler(BaseHandler):
         tracks_new = set((p['name'], track_id) for p in playlists_new.values() for track_id in p['tracks'])
 
         playlists_old = session['playlists']
-        tracks_old = set((p['name'], t['_id']) for p in playlists_old.values() for t in p['tracks'] if t)
+        tracks_old = set((p['name'], track_id) for p in playlists_old.values() for track_id in p['tracks'])
 
         tracks_added = tracks_new - tracks_old
         tracks_removed = tracks_old - tracks_new
 
         check_metadata = False
+        deltas = []
+        playlisted = [(track_id, 1) for _, track_id in tracks_added] + [(track_id, -1) for _, track_id in tracks_removed]
         for playlist_name, track_id in tracks_added:
             for function in playlists_new[playlist_name].get('functions', []):
-                self.database.update_function_counter(track_id, function, 1)
+                deltas.append((track_id, function, 1))
 
             # Check metadata for the new tracks in the identity playlist
             if  playlists_new[playlist_name].get('type', 'user') == 'identity':
-                track = self.database.get_track(track_id)
+                track = yield self.database.deferred.get_track(track_id)
                 self.database.metadata_checker.check_track(track, add_sources=True)
                 check_metadata = True
 
         for playlist_name, track_id in tracks_removed:
             for function in playlists_old[playlist_name].get('functions', []):
-                self.database.update_function_counter(track_id, function, -1)
+                deltas.append((track_id, function, -1))
+
+        yield self.database.deferred.update_function_counters(deltas, playlisted)
+        self.search.artists.update_membership(self.membership_changes(tracks_old, tracks_new))
 
         # Update radios
         response = {}
         for playlist_name, playlist in playlists_new.iteritems():
-            radio = self.database.find_radio(token, playlist_name)
+            radio = yield self.database.deferred.find_radio(token, playlist_name)
             radio_enabled = playlist.pop('radio_enabled', False)
             if radio_enabled and radio is None:
-                radio_id = self.database.add_radio(token, playlist_name)
+                radio_id = yield self.database.deferred.add_radio(token, playlist_name)
                 playlist['radio_id'] = radio_id
                 response['radios_created'] = response.get('radios_created', [])
                 response['radios_created'].append(radio_id)
             if not radio_enabled and radio is not None:
-                self.database.delete_radio(radio['_id'])
+                yield self.database.deferred.delete_radio(radio['_id'])
                 response['radios_deleted'] = response.get('radios_deleted', [])
                 response['radios_deleted'].append(radio['_id'])
         for playlist_name, playlist in playlists_old.iteritems():
             if playlist_name not in playlists_new:
-                radio = self.database.find_radio(token, playlist_name)
+                radio = yield self.database.deferred.find_radio(token, playlist_name)
                 if radio is not None:
-                    self.database.delete_radio(radio['_id'])
+                    yield self.database.deferred.delete_radio(radio['_id'])
                     response['radios_deleted'] = response.get('radios_deleted', [])
                     response['radios_deleted'].append(radio['_id'])
 
-        self.database.update_session(token, playlists_new)
+        yield self.database.deferred.update_session(token, playlists_new)
+
+        fingerprint = self.identity_fingerprint(playlists_old)
+        if fingerprint != self.identity_fingerprint(playlists_new):
+            self.search.recommend_cache.pop(fingerprint)
+            self.warm_recommendations(token)
 
         # Run the metadata checker (needs to be called after update_session)
         if check_metadata and not self.database.metadata_checker.checking:
             self.database.metadata_checker.check_all()
 
-        return response
+        defer.returnValue(response)
+
+    @inlineCallbacks
+    def _process_PATCH(self, request):
+        token = request.args['token'][0] if 'token' in request.args else None
+        session = yield self.database.deferred.get_session(token, resolve_tracks=False)
+        if session is None:
+            defer.returnValue(self.error(request, 'cannot find session', 404))
+
+        body = json.loads(request.content.read())
+        if not isinstance(body, dict) or not isinstance(body.get('operations', []), list):
+            defer.returnValue(self.error(request, 'invalid operations', 400))
+
+        version = body.get('version', session.get('version', 0))
+        if version != session.get('version', 0):
+            defer.returnValue(self.error(request, 'session has been modified', 409))
+
+        # Validate all operations against our copy of the playlists, before writing anything
+        playlists = session['playlists']
+        tracks_old = set((p['name'], track_id) for p in playlists.values() for track_id in p['tracks'])
+        fingerprint = self.identity_fingerprint(playlists)
+        changed = set()
+        deltas = []
+        playlisted = []
+        identity_tracks = []
+        renames = []
+        try:
+            for operation in body.get('operations', []):
+                changed.update(self.apply_operation(playlists, operation, deltas, playlisted, identity_tracks, renames))
+        except (KeyError, ValueError, TypeError, AttributeError) as e:
+            defer.returnValue(self.error(request, 'invalid operation (%s)' % e, 400))
+
+        # Write the changed playlists in a single update, so either all operations are applied or none
+        update = {}
+        for playlist_name in changed:
+            if playlist_name in playlists:
+                update.setdefault('$set', {})['playlists.' + playlist_name] = playlists[playlist_name]
+            else:
+                update.setdefault('$unset', {})['playlists.' + playlist_name] = ''
+        if update:
+            patched = yield self.database.deferred.patch_session(token, version, update)
+            if not patched:
+                defer.returnValue(self.error(request, 'session has been modified', 409))
+            version += 1
+
+        yield self.database.deferred.update_function_counters(deltas, playlisted)
+        tracks_new = set((p['name'], track_id) for p in playlists.values() for track_id in p['tracks'])
+        self.search.artists.update_membership(self.membership_changes(tracks_old, tracks_new))
+
+        for playlist_name, new_playlist_name in renames:
+            yield self.database.deferred.rename_radio(token, playlist_name, new_playlist_name)
+
+        if fingerprint != self.identity_fingerprint(playlists):
+            self.search.recommend_cache.pop(fingerprint)
+            self.warm_recommendations(token)
+
+        # Check metadata for the new tracks in the identity playlist
+        if identity_tracks:
+            tracks = yield self.database.deferred.get_tracks(identity_tracks)
+            for track in tracks.itervalues():
+                self.database.metadata_checker.check_track(track, add_sources=True)
+            if not self.database.metadata_checker.checking:
+                self.database.metadata_checker.check_all()
+
+        request.responseHeaders.addRawHeader('X-Session-Version', str(version))
+        defer.returnValue({'version': version})
+
+    def identity_fingerprint(self, playlists):
+        for playlist in playlists.itervalues():
+            if playlist.get('type', 'user') == 'identity':
+                return playlist_fingerprint(playlist)
+
+    @inlineCallbacks
+    def warm_recommendations(self, token):
+        # Compute the recommendations in the background, so the next request for them is served from memory
+        try:
+            session = yield self.database.deferred.get_session(token)
+            for playlist in session['playlists'].itervalues():
+                if playlist.get('type', 'user') == 'identity':
+                    yield self.search.recommend_cached(playlist)
+        except Exception as e:
+            logging.getLogger(__name__).error('Failed to precompute recommendations (reason: %s)', e)
+
+    def membership_changes(self, tracks_old, tracks_new):
+        # Turns the sets of (playlist name, track id) tuples into (other track ids, track id, delta) tuples for the artist index
+        changes = []
+        members = {}
+        for playlist_name, track_id in tracks_old:
+            members.setdefault(playlist_name, []).append(track_id)
+        for playlist_name, track_id in tracks_old - tracks_new:
+            members[playlist_name].remove(track_id)
+            changes.append((list(members[playlist_name]), track_id, -1))
+        for playlist_name, track_id in tracks_new - tracks_old:
+            changes.append((list(members.get(playlist_name, [])), track_id, 1))
+            members.setdefault(playlist_name, []).append(track_id)
+        return changes
+
+    def apply_operation(self, playlists, operation, deltas, playlisted, identity_tracks, renames):
+        # Applies the operation to playlists and returns the names of the playlists it changed
+        if not isinstance(operation, dict):
+            raise ValueError('operation must be an object')
+        op = operation['op']
+        playlist_name = operation['playlist']
+        # Names end up in 'playlists.<name>' update paths, so they can't be patched if they contain dots
+        if not self.valid_playlist_name(playlist_name):
+            raise ValueError('invalid playlist name %s' % playlist_name)
+        if playlist_name not in playlists:
+            raise ValueError('unknown playlist %s' % playlist_name)
+        playlist = playlists[playlist_name]
+
+        if op == 'add':
+            track_id = operation['track_id']
+            index = int(operation.get('index', len(playlist['tracks'])))
+            if track_id in playlist['tracks']:
+                raise ValueError('track %s is already in playlist' % track_id)
+            playlist['tracks'].insert(index, track_id)
+            deltas.extend((track_id, function, 1) for function in playlist.get('functions', []))
+            playlisted.append((track_id, 1))
+            if playlist.get('type', 'user') == 'identity':
+                identity_tracks.append(track_id)
+            return [playlist_name]
+
+        elif op == 'remove':
+            track_id = operation['track_id']
+            if track_id not in playlist['tracks']:
+                raise ValueError('track %s is not in playlist' % track_id)
+            playlist['tracks'].remove(track_id)
+            deltas.extend((track_id, function, -1) for function in playlist.get('functions', []))
+            playlisted.append((track_id, -1))
+            return [playlist_name]
+
+        elif op == 'move':
+            track_id = operation['track_id']
+            if track_id not in playlist['tracks']:
+                raise ValueError('track %s is not in playlist' % track_id)
+            playlist['tracks'].remove(track_id)
+            playlist['tracks'].insert(int(operation['index']), track_id)
+            return [playlist_name]
+
+        elif op == 'rename':
+            new_playlist_name = operation['name']
+            if not self.valid_playlist_name(new_playlist_name):
+                raise ValueError('invalid playlist name %s' % new_playlist_name)
+            if new_playlist_name in playlists:
+                raise ValueError('playlist %s already exists' % new_playlist_name)
+            playlist['name'] = new_playlist_name
+            playlists[new_playlist_name] = playlists.pop(playlist_name)
+            renames.append((playlist_name, new_playlist_name))
+            return [playlist_name, new_playlist_name]
+
+        elif op == 'set_functions':
+            if not isinstance(operation['functions'], list) or not all(isinstance(f, basestring) for f in operation['functions']):
+                raise ValueError('functions must be a list of strings')
+            functions_old = set(playlist.get('functions', []))
+            functions_new = set(operation['functions'])
+            for track_id in playlist['tracks']:
+                deltas.extend((track_id, function, 1) for function in functions_new - functions_old)
+                deltas.extend((track_id, function, -1) for function in functions_old - functions_new)
+            playlist['functions'] = operation['functions']
+            return [playlist_name]
+
+        raise ValueError('unknown op %s' % op)
+
+    def valid_playlist_name(self, playlist_name):
+        return isinstance(playlist_name, basestring) and playlist_name != '' and '.' not in playlist_name and not playlist_name.startswith('$')
 
 
 class TracksHandler(BaseHandler):
@@ -200,29 +398,32 @@ class TracksHandler(BaseHandler):
         id = request.args['id'][0] if 'id' in request.args else None
         offset = request.args['offset'][0] if 'offset' in request.args else 0
         page_size = request.args['pagesize'][0] if 'pagesize' in request.args else 0
+        sort = request.args['sort'][0] if 'sort' in request.args else 'popularity'
 
         if bool(query) == bool(id):
             defer.returnValue(self.error(request, 'please use either the query or the id param', 400))
 
         if id:
-            track = self.database.get_track(id)
+            track = yield self.database.deferred.get_track(id)
             if track is None:
                 defer.returnValue(self.error(request, 'track does not exist', 404))
             defer.returnValue(track)
 
-        results = yield self.search.search(query)
-        results.sort(key=lambda x: x.get('stats', {}).get('playlisted', 0), reverse=True)
+        if sort not in ['relevance', 'popularity']:
+            defer.returnValue(self.error(request, 'sort should be either relevance or popularity', 400))
 
         offset = int(offset)
         page_size = int(page_size) or int(self.config.get('api', 'page_size'))
 
-        if offset > len(results):
+        page = yield self.search.search_page(query, offset=offset, size=page_size, sort=sort)
+
+        if offset > page['total']:
             defer.returnValue(self.error(request, 'offset is larger then result-set', 404))
         else:
             defer.returnValue({'offset': offset,
                                'page_size': page_size,
-                               'total': len(results),
-                               'results': results[offset:offset+page_size]})
+                               'total': page['total'],
+                               'results': page['results']})
 
 
 class RecommendHandler(BaseHandler):
@@ -234,7 +435,7 @@ class RecommendHandler(BaseHandler):
         offset = request.args['offset'][0] if 'offset' in request.args else 0
         page_size = request.args['pagesize'][0] if 'pagesize' in request.args else 0
 
-        session = self.database.get_session(token)
+        session = yield self.database.deferred.get_session(token)
         if session is None:
             defer.returnValue(self.error(request, 'cannot find session', 404))
 
@@ -251,10 +452,11 @@ class RecommendHandler(BaseHandler):
         results = None
         if ident_playlist:
             offset = int(offset)
-            results = yield self.search.recommend(ident_playlist)
+            results = yield self.search.recommend_cached(ident_playlist)
         if results is None:
             offset = 0
-            results = self.database.get_random_tracks(page_size)
+            exclude = [t['_id'] for t in ident_playlist['tracks'] if t] if ident_playlist else None
+            results = yield self.database.deferred.get_random_tracks(page_size, exclude=exclude)
 
         # Return the recommendations
         if offset > len(results):
@@ -268,61 +470,262 @@ class RecommendHandler(BaseHandler):
         defer.returnValue(response)
 
 
+class SuggestHandler(BaseHandler):
+
+    @inlineCallbacks
+    def _process_GET(self, request):
+        ids = request.args['ids'][0].split(',') if 'ids' in request.args else None
+        query = request.args['query'][0] if 'query' in request.args else None
+        token = request.args['token'][0] if 'token' in request.args else None
+        name = request.args['name'][0] if 'name' in request.args else None
+        limit = int(request.args['limit'][0]) if 'limit' in request.args else SUGGEST_LIMIT
+
+        if not self.search.terms.ready:
+            defer.returnValue(self.error(request, 'term index is not ready yet', 503))
+
+        # Without ids, query or playlist we suggest the most frequent terms of the whole catalogue
+        track_ids = ids
+        exclude = set()
+        if query:
+            results = yield self.search.search(query)
+            track_ids = [result['_id'] for result in results]
+            exclude = set([query] + query.split())
+        elif token:
+            session = yield self.database.deferred.get_session(token, resolve_tracks=False)
+            if session is None:
+                defer.returnValue(self.error(request, 'cannot find session', 404))
+            if name not in session['playlists']:
+                defer.returnValue(self.error(request, 'cannot find playlist', 404))
+            track_ids = session['playlists'][name]['tracks']
+
+        terms = self.search.terms.top_terms(track_ids, limit, exclude)
+        defer.returnValue({'terms': [{'term': term, 'count': count} for term, count in terms]})
+
+
+class AutocompleteHandler(BaseHandler):
+
+    def _process_GET(self, request):
+        # Completions come straight from memory, so there's nothing to wait for
+        query = request.args['query'][0] if 'query' in request.args else None
+        limit = int(request.args['limit'][0]) if 'limit' in request.args else AUTOCOMPLETE_LIMIT
+
+        if not query:
+            return defer.succeed(self.error(request, 'please use the query param', 400))
+        if not self.search.autocomplete.ready:
+            return defer.succeed(self.error(request, 'autocomplete index is not ready yet', 503))
+
+        completions = self.search.autocomplete.complete(query, limit)
+        return defer.succeed({'completions': [{'text': text, 'type': type, 'weight': weight} for text, type, weight in completions]})
+
+
+@implementer(IPushProducer)
+class ClicklogProducer(object):
+    # Writes the clicklog as a JSON array or as NDJSON, one page at a time, pausing whenever the client can't keep up
+
+    def __init__(self, request, database, app=None, since=None, until=None, cursor=None, limit=0, format='ndjson'):
+        self.logger = logging.getLogger(__name__)
+        self.request = request
+        self.database = database
+        self.format = format
+        self.app = app
+        self.since = since
+        self.until = until
+        self.cursor = cursor
+        self.limit = limit
+        self.paused = None
+        self.stopped = False
+
+    @inlineCallbacks
+    def start(self):
+        self.request.registerProducer(self, True)
+
+        count = 0
+        try:
+            while not self.stopped:
+                if self.paused is not None:
+                    yield self.paused
+
+                page_size = min(CLICKLOG_PAGE_SIZE, self.limit - count) if self.limit else CLICKLOG_PAGE_SIZE
+                page = yield self.database.deferred.get_clicklog_page(self.app, self.since, self.until, self.cursor, page_size)
+                if page and not self.stopped:
+                    self.cursor = page[-1]['_id']
+                    self.request.write(self.serialize(page, count == 0))
+                    count += len(page)
+
+                if len(page) < page_size or count == self.limit:
+                    break
+        finally:
+            self.request.unregisterProducer()
+
+        if not self.stopped:
+            if self.format == 'json':
+                self.request.write(']' if count else '[]')
+            self.request.finish()
+
+    def serialize(self, page, first):
+        if self.format == 'json':
+            # The array is written incrementally, the ids are only needed as cursor when streaming NDJSON
+            for clicklog in page:
+                del clicklog['_id']
+            return ('[' if first else ',') + ','.join(json.dumps(clicklog) for clicklog in page)
+        return ''.join(json.dumps(clicklog) + '\n' for clicklog in page)
+
+    def on_error(self, failure):
+        self.logger.error('Failed to export clicklog (reason: %s)', failure.getErrorMessage())
+        if self.stopped or self.request.finished:
+            return
+        if not self.request.startedWriting:
+            self.request.setResponseCode(500)
+            self.request.write(json.dumps({'error': 'cannot read clicklog'}))
+            self.request.finish()
+        else:
+            # Drop the connection instead of finishing, so the client can tell the export is incomplete
+            self.request.transport.abortConnection()
+
+    def pauseProducing(self):
+        if self.paused is None:
+            self.paused = defer.Deferred()
+
+    def resumeProducing(self):
+        if self.paused is not None:
+            paused, self.paused = self.paused, None
+            paused.callback(None)
+
+    def stopProducing(self):
+        self.stopped = True
+        self.resumeProducing()
+
+
 class ClicklogHandler(BaseHandler):
 
-    @json_out
-    def render_GET(self, request):
+    @inlineCallbacks
+    def _process_GET(self, request):
         app = request.args['app'][0] if 'app' in request.args else None
         limit = request.args['limit'][0] if 'limit' in request.args else 0
+        format = request.args['format'][0] if 'format' in request.args else 'json'
+        since = request.args['since'][0] if 'since' in request.args else None
+        until = request.args['until'][0] if 'until' in request.args else None
+        cursor = request.args['cursor'][0] if 'cursor' in request.args else None
 
         # Make sure the user is authorized (HTTP basic authentication)
-        authorized = any([user['name'] == request.getUser() and user['password'] == request.getPassword() for user in self.database.get_users()])
+        authorized = yield self.database.deferred.verify_user(request.getUser(), request.getPassword())
         if not authorized:
             request.responseHeaders.addRawHeader('WWW-Authenticate', 'Basic realm="Billy"')
-            return self.error(request, 'authentication failed', 401)
-
-        clicklog = list(self.database.get_clicklog(app, int(limit)))
-        return clicklog
+            defer.returnValue(self.error(request, 'authentication failed', 401))
+
+        if format not in ('json', 'ndjson'):
+            defer.returnValue(self.error(request, 'unknown format %s' % format, 400))
+
+        # Stream the clicklog (when using NDJSON, clients can resume using the _id of the last line as cursor)
+        if format == 'ndjson':
+            request.responseHeaders.setRawHeaders('content-type', ['application/x-ndjson'])
+        producer = ClicklogProducer(request, self.database, app,
+                                    int(since) if since else None,
+                                    int(until) if until else None,
+                                    cursor, int(limit), format)
+        d = producer.start()
+        d.addErrback(producer.on_error)
+        defer.returnValue(server.NOT_DONE_YET)
 
-    @json_out
-    def render_POST(self, request):
+    @inlineCallbacks
+    def _process_POST(self, request):
         app = request.args['app'][0] if 'app' in request.args else 'billy'
 
         body = request.content.read()
         json_body = json.loads(body)
 
+        # Clients may send a single event or a list of events
+        events = json_body if isinstance(json_body, list) else [json_body]
+        if not all(isinstance(event, dict) for event in events):
+            defer.returnValue(self.error(request, 'events should be JSON objects', 400))
+
+        token = None
         if app == 'billy':
             token = request.args['token'][0] if 'token' in request.args else None
-            session = self.database.get_session(token)
+            session = yield self.database.deferred.get_session(token, resolve_tracks=False)
             if session is None:
-                return self.error(request, 'cannot find session', 404)
-            json_body['token'] = token
+                defer.returnValue(self.error(request, 'cannot find session', 404))
 
-        json_body['app'] = app
-        json_body['user-agent'] = request.getAllHeaders().get('user-agent', '')
-        json_body['ip'] = request.getClientIP()
-        json_body['time'] = int(time.time())
+        now = int(time.time())
+        for event in events:
+            if token is not None:
+                event['token'] = token
+            event['app'] = app
+            event['user-agent'] = request.getAllHeaders().get('user-agent', '')
+            event['ip'] = request.getClientIP()
+            event['time'] = now
 
-        self.database.add_clicklog(json_body)
+        if not self.database.clicklog_buffer.add(events):
+            defer.returnValue(self.error(request, 'clicklog is busy, try again later', 503))
 
 
 class WaveformHandler(BaseHandler):
 
-    @json_out
-    def render_GET(self, request):
-        id = request.args['id'][0] if 'id' in request.args else None
-        waveform = self.database.get_waveform(id)
-        if waveform is None:
-            return self.error(request, 'cannot find waveform', 404)
+    def __init__(self, *args):
+        BaseHandler.__init__(self, *args)
+        if self.config.has_option('waveforms', 'path'):
+            self.store = WaveformStore(os.path.join(CURRENT_DIR, self.config.get('waveforms', 'path')))
+        else:
+            self.store = WaveformStore()
 
-        return {'waveform': waveform['waveform']}
+    @inlineCallbacks
+    def _process_GET(self, request):
+        id = request.args['id'][0] if 'id' in request.args else None
+        ids = request.args['ids'][0].split(',') if 'ids' in request.args else None
+        format = request.args['format'][0] if 'format' in request.args else 'json'
+
+        if bool(id) == bool(ids):
+            defer.returnValue(self.error(request, 'please use either the id or the ids param', 400))
+        if format not in ['json', 'base64', 'binary'] or (format == 'binary' and ids):
+            defer.returnValue(self.error(request, 'unsupported format', 400))
+
+        # Try the packed waveforms first, and only query MongoDB for what's missing
+        waveforms = {}
+        for track_id in ids or [id]:
+            data = self.store.get(track_id)
+            if data is not None:
+                waveforms[track_id] = data
+
+        missing = [track_id for track_id in ids or [id] if track_id not in waveforms]
+        if missing:
+            results = yield self.database.deferred.get_waveforms(missing)
+            for track_id, waveform in results.iteritems():
+                waveforms[track_id] = encode_waveform(waveform)
+
+        if format == 'binary':
+            if id not in waveforms:
+                defer.returnValue(self.error(request, 'cannot find waveform', 404))
+            request.responseHeaders.setRawHeaders('content-type', ['application/octet-stream'])
+            request.write(waveforms[id])
+            request.finish()
+            defer.returnValue(server.NOT_DONE_YET)
+
+        encode = decode_waveform if format == 'json' else base64.b64encode
+        if ids:
+            defer.returnValue({'waveforms': dict((track_id, encode(data)) for track_id, data in waveforms.iteritems())})
+
+        if id not in waveforms:
+            defer.returnValue(self.error(request, 'cannot find waveform', 404))
+        defer.returnValue({'waveform': encode(waveforms[id])})
 
 
 class InfoHandler(BaseHandler):
 
-    @json_out
-    def render_GET(self, request):
-        return {'info': self.database.get_info()}
+    @inlineCallbacks
+    def _process_GET(self, request):
+        info = yield self.database.deferred.get_info()
+        info['http_pools'] = get_pool_stats()
+        info['search_cache'] = self.search.cache.stats()
+        info['index_queue'].update(self.search.index_queue.stats())
+        info['artist_index'] = self.search.artists.stats()
+        info['recommend_cache'] = self.search.recommend_cache.stats()
+        info['term_index'] = self.search.terms.stats()
+        info['autocomplete'] = self.search.autocomplete.stats()
+        if self.search.local is not None:
+            info['local_index'] = self.search.local.stats()
+        if self.search.vectors is not None:
+            info['vector_index'] = self.search.vectors.stats()
+        defer.returnValue({'info': info})
 
 
 def main(argv):
@@ -352,7 +755,14 @@ def main(argv):
 
     database = Database(config, (args.dbname or 'billy'))
     search = Search(database, config)
-    database.set_track_callbacks(search.index, search.update)
+    search.start_index_queue()
+    search.start_local_index()
+    search.start_artist_index()
+    search.start_term_index()
+    search.start_autocomplete()
+    if config.has_option('recommend', 'backend') and config.get('recommend', 'backend') == 'vectors':
+        search.start_vector_index()
+    database.set_track_callbacks(search.index_queue.add, search.index_queue.add)
 
     # Import tracks
     if args.tracks:
@@ -362,10 +772,10 @@ def main(argv):
             for track in tracks:
                 waveform = track.pop('waveform', None)
 
-                track_id = database.add_track(track)
+                track = database.add_track(track)
 
-                if track_id and waveform is not None:
-                    database.add_waveform(track_id, waveform)
+                if track and waveform is not None:
+                    database.add_waveform(track['_id'], waveform)
             logger.info('Finished importing tracks')
 
     # Import sources
@@ -73,11 +73,12 @@ class SourceChecker(object):
         self.checking = False
         self.sources = {}
 
-        self.load_sources()
-        self.check_loop()
+        d = self.load_sources()
+        d.addCallback(lambda _: self.check_loop())
 
+    @inlineCallbacks
     def load_sources(self):
-        sources = self.database.get_all_sources()
+        sources = yield self.database.deferred.get_all_sources()
 
         for source_dict in sources:
             source = self.create_source(source_dict)
@@ -107,9 +108,10 @@ class SourceChecker(object):
         for track in tracks:
             track['sources'] = [source_id]
 
-        count = self.database.add_tracks(tracks)
-        self.logger.info('Got %s track(s) for source %s (%s are new)', len(tracks), source, count)
-        self.database.set_source_last_check(source_id, source.last_check)
+        result = yield self.database.deferred.add_tracks(tracks)
+        self.logger.info('Got %s track(s) for source %s (%s are new, %s merged, %s failed)',
+                         len(tracks), source, result['inserted'], result['merged'], result['failed'])
+        yield self.database.deferred.set_source_last_check(source_id, source.last_check)
 
     @inlineCallbacks
     def check_loop(self):
@@ -0,0 +1,70 @@
+import heapq
+import logging
+
+from util import BackgroundIndex
+from collections import Counter
+
+
+class TermIndex(BackgroundIndex):
+    # Keeps the index terms of every track and how often each term occurs in the catalogue, so frequent
+    # terms never have to be derived from the tracks again
+
+    def __init__(self, terms):
+        BackgroundIndex.__init__(self)
+        self.logger = logging.getLogger(__name__)
+
+        # Function that returns the index terms of a track
+        self.terms = terms
+        self.track_terms = {}
+        self.counts = Counter()
+        self.top = None
+
+    def start(self, database):
+        # Afterwards every change reaches us through add_tracks, so there's no need to rebuild periodically
+        def build():
+            projection = {'title': 1, 'musicinfo': 1}
+            return dict((track['_id'], self._terms(track)) for track in database.get_all_tracks(projection=projection))
+
+        def swap(track_terms):
+            self.track_terms = track_terms
+            self.counts = Counter()
+            for terms in track_terms.itervalues():
+                self.counts.update(terms)
+            self.top = None
+            self.logger.info('Built term index (%s terms, %s tracks)', len(self.counts), len(self.track_terms))
+
+        return self.build_in_background(database.threadpool, build, swap, 'term index')
+
+    def _terms(self, track):
+        # Most terms are shared by many tracks, so we only keep a single copy of each
+        return tuple(intern(term) for term in self.terms(track))
+
+    def _apply(self, tracks):
+        for track in tracks:
+            for term in self.track_terms.get(track['_id'], ()):
+                self.counts[term] -= 1
+                if self.counts[term] <= 0:
+                    del self.counts[term]
+            terms = self._terms(track)
+            self.track_terms[track['_id']] = terms
+            self.counts.update(terms)
+        self.top = None
+
+    def top_terms(self, track_ids=None, limit=20, exclude=()):
+        # Returns the (term, count) tuples of the most frequent terms of the given tracks, or of the whole catalogue
+        if track_ids is None:
+            # The catalogue-wide top is only computed again after something changed
+            if self.top is None or len(self.top) < limit + len(exclude):
+                self.top = heapq.nlargest(limit + len(exclude), self.counts.iteritems(), key=lambda x: x[1])
+            candidates = self.top
+        else:
+            counts = Counter()
+            for track_id in track_ids:
+                counts.update(self.track_terms.get(track_id, ()))
+            candidates = counts.iteritems()
+        return heapq.nlargest(limit, ((term, count) for term, count in candidates if term not in exclude), key=lambda x: x[1])
+
+    def stats(self):
+        return {'ready': self.ready,
+                'terms': len(self.counts),
+                'tracks': len(self.track_terms)}
@@ -0,0 +1,26 @@
+import os
+import sys
+import time
+import logging
+import ConfigParser
+
+# Ugly import hack
+CURRENT_DIR = os.path.dirname(os.path.realpath(__file__))
+PARENT_DIR = os.path.realpath(os.path.join(CURRENT_DIR, os.pardir))
+sys.path.append(PARENT_DIR)
+
+from database import *
+from waveforms import *
+
+logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+
+config = ConfigParser.ConfigParser()
+config.read(os.path.join(PARENT_DIR, 'billy.conf'))
+
+database = Database(config, sys.argv[1])
+path = sys.argv[2] if len(sys.argv) > 2 else WAVEFORMS_PATH
+
+start = time.time()
+waveforms = ((waveform['_id'], waveform['waveform']) for waveform in database.db.waveforms.find({}))
+count = WaveformStore.pack(waveforms, path)
+print 'Packed', count, 'waveform(s) into', path, 'in %.1fs' % (time.time() - start)
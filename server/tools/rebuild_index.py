@@ -3,9 +3,10 @@ import sys
 import json
 import time
 import logging
+import argparse
 import ConfigParser
 
-from twisted.internet import reactor, defer
+from twisted.internet import reactor, defer, threads
 from twisted.internet.defer import inlineCallbacks
 
 # Ugly import hack
@@ -17,32 +18,148 @@ from util import *
 from search import *
 from database import *
 
+ES_ALIAS_URL = 'http://{host}:{port}/_alias/{alias}'
+ES_ALIASES_URL = 'http://{host}:{port}/_aliases'
+ES_COUNT_URL = 'http://{host}:{port}/{index}/_count'
+ES_REFRESH_URL = 'http://{host}:{port}/{index}/_refresh'
+ES_SETTINGS_URL = 'http://{host}:{port}/{index}/_settings'
+
+# Enough tracks to keep all concurrent bulk requests busy
+CHUNK_SIZE = BULK_BATCH_SIZE * BULK_MAX_CONCURRENCY * 2
+# Tracks updated shortly before we started may not have been indexed yet either
+CATCH_UP_MARGIN = 60
+
+parser = argparse.ArgumentParser(description='Build a new version of the Elasticsearch index and swap it in without downtime')
+parser.add_argument('dbname', help='Name of the MongoDB database (also the name of the index alias)')
+parser.add_argument('--resume', help='Continue the previous rebuild from its checkpoint', action='store_true')
+parser.add_argument('--keep-old', help='Keep the previous version of the index', action='store_true')
+args = parser.parse_args()
+
 logging.basicConfig(stream=sys.stdout, level=logging.INFO)
 
 config = ConfigParser.ConfigParser()
-config.read(os.path.join(CURRENT_DIR, 'billy.conf'))
+config.read(os.path.join(PARENT_DIR, 'billy.conf'))
 
-database = Database(config, sys.argv[1])
+database = Database(config, args.dbname)
 search = Search(database, config)
-index_name = database.db.name
+alias = database.db.name
+checkpoint_path = os.path.join(PARENT_DIR, 'data', 'rebuild_index_%s.json' % alias)
+
+
+def es_url(url, **kwargs):
+    return url.format(host=search.host, port=search.port, **kwargs)
 
-@inlineCallbacks
-def rebuild_index():
-    yield delete_request('http://{host}:{port}/{index}'.format(host=search.host,
-                                                               port=search.port,
-                                                               index=index_name))
-    print 'Deleted index', index_name, 'from Elasticsearch server'
 
-    chunk_size = 10000
-    index = 0
+def save_checkpoint(checkpoint):
+    if not os.path.exists(os.path.dirname(checkpoint_path)):
+        os.makedirs(os.path.dirname(checkpoint_path))
+    with open(checkpoint_path + '.tmp', 'wb') as fp:
+        json.dump(checkpoint, fp)
+    os.rename(checkpoint_path + '.tmp', checkpoint_path)
+
+
+@inlineCallbacks
+def stream(index, query=None, after=None, checkpoint=None):
+    # The next page is read from MongoDB while the current one is being indexed
+    start = time.time()
+    count = 0
+    next_page = database.deferred.get_tracks_page(after, CHUNK_SIZE, query)
     while True:
-        tracks = list(database.db.tracks.find({}).skip(index * chunk_size).limit(chunk_size))
+        tracks = yield next_page
         if not tracks:
             break
-        yield search.index(tracks)
-        index += 1
-    print 'Done'
-    reactor.stop()
+        next_page = database.deferred.get_tracks_page(tracks[-1]['_id'], CHUNK_SIZE, query)
+
+        rejected = []
+        track_ids = yield search.bulk(tracks, 'index', index=index, rejected=rejected)
+        if len(track_ids) + len(rejected) < len(tracks):
+            raise Exception('failed to index %s track(s), use --resume to try again' % (len(tracks) - len(track_ids) - len(rejected)))
+        count += len(track_ids)
+
+        if checkpoint is not None:
+            # Tracks that Elasticsearch rejects would be rejected again, so they don't stop us
+            checkpoint['after'] = tracks[-1]['_id']
+            checkpoint['count'] += len(track_ids)
+            checkpoint['rejected'] = checkpoint.get('rejected', 0) + len(rejected)
+            save_checkpoint(checkpoint)
+        print 'Indexed %s track(s) into %s (%.0f docs/sec)' % (count, index, count / max(time.time() - start, 0.001))
+    defer.returnValue(count)
+
+
+@inlineCallbacks
+def rebuild_index():
+    checkpoint = None
+    if args.resume and os.path.exists(checkpoint_path):
+        with open(checkpoint_path, 'rb') as fp:
+            checkpoint = json.load(fp)
+        print 'Resuming rebuild of', checkpoint['index'], 'after', checkpoint['count'], 'track(s)'
+    elif args.resume:
+        print 'No checkpoint found, starting a new rebuild'
+
+    if checkpoint is None:
+        # Refreshing is pointless while we're still loading the index
+        index = '%s_%d' % (alias, int(time.time()))
+        response = yield search.create_index(index, settings={'refresh_interval': '-1'})
+        if not response.json.get('acknowledged', False):
+            raise Exception('failed to create index %s (%s)' % (index, response.content))
+        checkpoint = {'index': index, 'after': None, 'count': 0, 'started': time.time()}
+        save_checkpoint(checkpoint)
+        print 'Created index', index
+
+    index = checkpoint['index']
+    start = time.time()
+    yield stream(index, after=checkpoint['after'], checkpoint=checkpoint)
+
+    # Index the tracks that changed after we streamed them
+    catch_up = time.time()
+    num_tracks = yield threads.deferToThread(database.db.tracks.count)
+    count = yield stream(index, query={'updated': {'$gte': checkpoint['started'] - CATCH_UP_MARGIN}})
+    print 'Caught up with', count, 'changed track(s)'
+
+    yield put_request(es_url(ES_SETTINGS_URL, index=index), data=json.dumps({'index': {'refresh_interval': '1s'}}))
+    yield post_request(es_url(ES_REFRESH_URL, index=index))
+
+    # Never swap in an index that is missing tracks
+    response = yield get_request(es_url(ES_COUNT_URL, index=index))
+    num_docs = response.json.get('count', 0)
+    if num_docs < num_tracks - checkpoint.get('rejected', 0):
+        raise Exception('index %s has %s document(s), but there are %s track(s) (%s rejected)' % (index, num_docs, num_tracks, checkpoint.get('rejected', 0)))
+
+    response = yield get_request(es_url(ES_ALIAS_URL, alias=alias))
+    old_indices = [name for name in response.json if name != index] if response.status_code == 200 else []
+    if not old_indices:
+        # Before we used aliases the index was named after the database, which is in the way of the alias
+        response = yield get_request(es_url(ES_MAPPING_URL, index=alias))
+        if response.status_code == 200:
+            print 'Deleting index', alias, 'to make room for the alias, search is unavailable until the alias exists'
+            yield delete_request(es_url(ES_MAPPING_URL, index=alias))
+
+    # Swap the alias in a single request, so searches always find an index
+    actions = [{'remove': {'index': name, 'alias': alias}} for name in old_indices]
+    actions.append({'add': {'index': index, 'alias': alias}})
+    response = yield post_request(es_url(ES_ALIASES_URL), data=json.dumps({'actions': actions}))
+    if not response.json.get('acknowledged', False):
+        raise Exception('failed to point alias %s to %s (%s)' % (alias, index, response.content))
+    print 'Alias', alias, 'now points to', index
+
+    # Tracks that changed until the swap were only sent to the old index
+    count = yield stream(index, query={'updated': {'$gte': catch_up - CATCH_UP_MARGIN}})
+    print 'Caught up with', count, 'changed track(s)'
+
+    if not args.keep_old:
+        for name in old_indices:
+            yield delete_request(es_url(ES_MAPPING_URL, index=name))
+            print 'Deleted index', name
+
+    os.remove(checkpoint_path)
+    elapsed = time.time() - start
+    print 'Done, indexed %s track(s) in %.0fs (%.0f docs/sec)' % (checkpoint['count'], elapsed, checkpoint['count'] / max(elapsed, 0.001))
+
+
+def main():
+    d = rebuild_index()
+    d.addErrback(lambda failure: sys.stdout.write('Rebuild failed: %s\n' % failure.getErrorMessage()))
+    d.addBoth(lambda _: reactor.stop())
 
-rebuild_index()
+reactor.callWhenRunning(main)
 reactor.run()
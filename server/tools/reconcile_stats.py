@@ -0,0 +1,22 @@
+import os
+import sys
+import json
+import logging
+import ConfigParser
+
+# Ugly import hack
+CURRENT_DIR = os.path.dirname(os.path.realpath(__file__))
+PARENT_DIR = os.path.realpath(os.path.join(CURRENT_DIR, os.pardir))
+sys.path.append(PARENT_DIR)
+
+from database import *
+
+logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+
+config = ConfigParser.ConfigParser()
+config.read(os.path.join(PARENT_DIR, 'billy.conf'))
+
+database = Database(config, sys.argv[1])
+stats = database.reconcile_stats()
+print 'Rebuilt catalogue stats for', database.db.name
+print json.dumps(stats, indent=2)
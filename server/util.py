@@ -1,5 +1,8 @@
 import json
+import time
+import hashlib
 import urllib
+import threading
 import urlparse
 import logging
 import cookielib
@@ -8,13 +11,18 @@ import dateutil.tz
 from datetime import datetime
 from StringIO import StringIO
 from collections import OrderedDict
-from twisted.web.client import Agent, CookieAgent, FileBodyProducer
+from twisted.web.client import Agent, CookieAgent, FileBodyProducer, HTTPConnectionPool
 from twisted.web.http_headers import Headers
 from twisted.internet.protocol import Protocol
-from twisted.internet import reactor, defer
+from twisted.internet import reactor, defer, threads
+from twisted.python import failure
 from twisted.web._newclient import _WrapperException
 from requests.cookies import create_cookie
 
+HTTP_MAX_PER_HOST = 8
+HTTP_IDLE_TIMEOUT = 240
+LRU_MAX_INVALIDATIONS = 100000
+
 
 class Response(object):
 
@@ -46,13 +54,69 @@ class BodyReceiver(Protocol):
         self.data += bytes
 
     def connectionLost(self, reason):
+        # The download may have been cancelled already
+        if self.finished.called:
+            return
         self.finished.callback(Response(self.status_code,
                                         self.headers,
                                         self.cookiejar,
                                         self.data))
 
 
-def http_request(method, url, params={}, data=None, headers={}, cookies=None, timeout=30, ignore_errors=True):
+class DiscardBody(Protocol):
+
+    def connectionMade(self):
+        # Abort the download (this closes the connection instead of returning it to the pool)
+        self.transport.stopProducing()
+
+
+class ConnectionPool(HTTPConnectionPool):
+    # Persistent connection pool that also limits the number of concurrent requests per host
+
+    def __init__(self, max_per_host=HTTP_MAX_PER_HOST, idle_timeout=HTTP_IDLE_TIMEOUT):
+        HTTPConnectionPool.__init__(self, reactor, persistent=True)
+        self.maxPersistentPerHost = max_per_host
+        self.cachedConnectionTimeout = idle_timeout
+        self.max_per_host = max_per_host
+        self.semaphores = {}
+        self.counters = {'requests': 0, 'new_connections': 0}
+
+    def acquire(self, host):
+        if host not in self.semaphores:
+            self.semaphores[host] = defer.DeferredSemaphore(self.max_per_host)
+        return self.semaphores[host].acquire()
+
+    def release(self, host):
+        self.semaphores[host].release()
+
+    def getConnection(self, key, endpoint):
+        self.counters['requests'] += 1
+        return HTTPConnectionPool.getConnection(self, key, endpoint)
+
+    def _newConnection(self, key, endpoint):
+        self.counters['new_connections'] += 1
+        return HTTPConnectionPool._newConnection(self, key, endpoint)
+
+    def get_stats(self):
+        return {'requests': self.counters['requests'],
+                'new_connections': self.counters['new_connections'],
+                'reused_connections': self.counters['requests'] - self.counters['new_connections'],
+                'waiting': sum(len(semaphore.waiting) for semaphore in self.semaphores.values())}
+
+
+_pools = {}
+
+def get_pool(name='default', **kwargs):
+    if name not in _pools:
+        _pools[name] = ConnectionPool(**kwargs)
+    return _pools[name]
+
+
+def get_pool_stats():
+    return dict((name, pool.get_stats()) for name, pool in _pools.iteritems())
+
+
+def http_request(method, url, params={}, data=None, headers={}, cookies=None, timeout=30, ignore_errors=True, pool='default'):
     # Urlencode does not accept unicode, so convert to str first
     url = url.encode('utf-8') if isinstance(url, unicode) else url
     for k, v in params.items():
@@ -80,20 +144,39 @@ def http_request(method, url, params={}, data=None, headers={}, cookies=None, ti
         data = urllib.urlencode(data)
         headers['Content-Type'] = 'application/x-www-form-urlencoded'
 
-    agent = Agent(reactor, connectTimeout=timeout)
+    pool = get_pool(pool)
+    host = url_parts[1]
+    agent = Agent(reactor, connectTimeout=timeout, pool=pool)
     cookie_agent = CookieAgent(agent, cookiejar)
     body = FileBodyProducer(StringIO(data)) if data else None
-    d = cookie_agent.request(method, url, Headers({k: [v] for k, v in headers.iteritems()}), body)
+
+    def send_request(_):
+        d = cookie_agent.request(method, url, Headers({k: [v] for k, v in headers.iteritems()}), body)
+        d.addCallback(handle_response, cookiejar)
+
+        # A response that never finishes would otherwise hold on to its slot forever
+        timeout_call = reactor.callLater(timeout, d.cancel)
+        def stop_timeout(result):
+            if timeout_call.active():
+                timeout_call.cancel()
+            elif isinstance(result, failure.Failure):
+                # Cancelling shows up as a CancelledError or a ResponseNeverReceived, depending on how far we got
+                raise Exception('no response after %s seconds' % timeout)
+            return result
+        d.addBoth(stop_timeout)
+        return d
 
     def handle_response(response, cookiejar):
-        if 'audio/mpeg' in response.headers.getRawHeaders('content-type')[-1]:
+        if 'audio/mpeg' in (response.headers.getRawHeaders('content-type') or [''])[-1]:
             # Don't download any multimedia files
+            response.deliverBody(DiscardBody())
             raise Exception('reponse contains a multimedia file')
-        d = defer.Deferred()
-        response.deliverBody(BodyReceiver(response.code,
-                                          dict(response.headers.getAllRawHeaders()),
-                                          cookiejar,
-                                          d))
+        d = defer.Deferred(lambda _: receiver.transport.stopProducing())
+        receiver = BodyReceiver(response.code,
+                                dict(response.headers.getAllRawHeaders()),
+                                cookiejar,
+                                d)
+        response.deliverBody(receiver)
         return d
 
     def handle_error(error):
@@ -105,7 +188,13 @@ def http_request(method, url, params={}, data=None, headers={}, cookies=None, ti
         logger.error('Failed to GET %s (reason: %s)', url, reason)
         return Response(0, {}, cookielib.CookieJar(), '')
 
-    d.addCallback(handle_response, cookiejar)
+    def release(result):
+        pool.release(host)
+        return result
+
+    d = pool.acquire(host)
+    d.addCallback(send_request)
+    d.addBoth(release)
     if ignore_errors:
         d.addErrback(handle_error)
     return d
@@ -144,6 +233,111 @@ class LimitedSizeDict(OrderedDict):
         self.popitem(last=False)
 
 
+class LRUCache(object):
+    # Thread-safe LRU cache that evicts entries once their combined size exceeds max_size (or once they are older than ttl)
+
+    def __init__(self, max_size, sizeof=len, ttl=None, max_invalidations=LRU_MAX_INVALIDATIONS):
+        self.max_size = max_size
+        self.sizeof = sizeof
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # Every pop bumps the generation, which lets set skip values that were read before they were invalidated
+        self.generation = 0
+        self.invalidations = OrderedDict()
+        self.max_invalidations = max_invalidations
+        self.forgotten = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return default
+            value, size, expires = self.entries.pop(key)
+            if expires is not None and expires < time.time():
+                self.size -= size
+                self.misses += 1
+                return default
+            self.hits += 1
+            self.entries[key] = (value, size, expires)
+            return value
+
+    def set(self, key, value, generation=None):
+        # Pass the generation from before the value was read, in case the key was popped while we were reading it
+        size = self.sizeof(value)
+        with self.lock:
+            if generation is not None and (generation < self.forgotten or self.invalidations.get(key, 0) > generation):
+                return
+            if key in self.entries:
+                self.size -= self.entries.pop(key)[1]
+            if size > self.max_size:
+                return
+            self.entries[key] = (value, size, time.time() + self.ttl if self.ttl else None)
+            self.size += size
+            while self.size > self.max_size:
+                _, (_, evicted_size, _) = self.entries.popitem(last=False)
+                self.size -= evicted_size
+                self.evictions += 1
+
+    def pop(self, key):
+        with self.lock:
+            self.generation += 1
+            self.invalidations.pop(key, None)
+            self.invalidations[key] = self.generation
+            if len(self.invalidations) > self.max_invalidations:
+                # We no longer know if older reads are still valid
+                self.forgotten = self.invalidations.popitem(last=False)[1]
+            if key in self.entries:
+                value, size, _ = self.entries.pop(key)
+                self.size -= size
+                return value
+
+    def stats(self):
+        with self.lock:
+            return {'entries': len(self.entries),
+                    'size': self.size,
+                    'max_size': self.max_size,
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions}
+
+
+class BackgroundIndex(object):
+    # Base class for in-memory indices that are built in a thread. Tracks that come in before the index is ready
+    # are kept aside and applied once it has been swapped in. Subclasses apply tracks in their _apply method.
+
+    def __init__(self):
+        self.logger = logging.getLogger(self.__class__.__module__)
+        self.pending = {}
+        self.ready = False
+
+    def build_in_background(self, threadpool, build, swap, description):
+        # Runs build in the thread pool (the reactor's own if threadpool is None) and passes the result to swap on the reactor thread
+        def done(result):
+            result = swap(result)
+            self.ready = True
+
+            # Apply whatever came in while we were building
+            pending, self.pending = self.pending, {}
+            self._apply(pending.values())
+            return result
+
+        d = threads.deferToThreadPool(reactor, threadpool or reactor.getThreadPool(), build)
+        d.addCallback(done)
+        d.addErrback(lambda failure: self.logger.error('Failed to build %s (reason: %s)', description, failure.value))
+        return d
+
+    def add_tracks(self, tracks):
+        if not self.ready:
+            self.pending.update((track['_id'], track) for track in tracks)
+            return
+        self._apply(tracks)
+
+
 def parse_title(title):
     # Try to split the title into artist and name components
     if title.count(' - ') == 1:
@@ -162,6 +356,12 @@ def datetime_to_ts(dt):
     return int((dt - epoch_dt).total_seconds())
 
 
+def playlist_fingerprint(playlist):
+    # Works for playlists with either tracks or track ids
+    track_ids = sorted(track['_id'] if isinstance(track, dict) else track for track in playlist['tracks'] if track)
+    return hashlib.sha1(json.dumps([track_ids, playlist.get('name', ''), playlist.get('description', '')])).hexdigest()
+
+
 def build_bool_query(bool_type, match_dict, nested_path=None):
     query = {'query': {'bool': {bool_type: []}}}
 
@@ -182,3 +382,8 @@ def build_simple_query(query, fields=['_all']):
 def build_query(query, field='_all'):
     return {'query': {'query_string': {'query': query, 'default_field': field}}}
 
+
+def build_popularity_query(query, field):
+    return {'query': {'function_score': {'query': query['query'],
+                                         'field_value_factor': {'field': field, 'modifier': 'log2p', 'missing': 0},
+                                         'boost_mode': 'multiply'}}}
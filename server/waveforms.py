@@ -0,0 +1,69 @@
+import os
+import json
+import mmap
+import logging
+
+CURRENT_DIR = os.path.dirname(os.path.realpath(__file__))
+WAVEFORMS_PATH = os.path.join(CURRENT_DIR, 'data', 'waveforms')
+
+
+class WaveformStore(object):
+    # Read-only store with all waveforms packed into a single uint8 file ({path}.bin) and an id -> (offset, length) index ({path}.idx)
+
+    def __init__(self, path=WAVEFORMS_PATH):
+        self.logger = logging.getLogger(__name__)
+
+        self.path = path
+        self.index = {}
+        self.data = None
+
+        self.load()
+
+    def load(self):
+        index_fn = self.path + '.idx'
+        data_fn = self.path + '.bin'
+        if not os.path.exists(index_fn) or not os.path.exists(data_fn):
+            self.logger.info('No packed waveforms found at %s', self.path)
+            return
+
+        with open(index_fn, 'rb') as fp:
+            self.index = json.load(fp)
+        with open(data_fn, 'rb') as fp:
+            if os.fstat(fp.fileno()).st_size > 0:
+                self.data = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+
+        self.logger.info('Loaded %s packed waveform(s)', len(self.index))
+
+    def get(self, track_id):
+        # Returns the waveform as a uint8 string
+        entry = self.index.get(track_id)
+        if entry is None or self.data is None:
+            return None
+        offset, length = entry
+        return self.data[offset:offset+length]
+
+    @staticmethod
+    def pack(waveforms, path=WAVEFORMS_PATH):
+        # Write the (track_id, waveform) pairs to a new pack, then swap it with the current one
+        index = {}
+        offset = 0
+        with open(path + '.bin.tmp', 'wb') as fp:
+            for track_id, waveform in waveforms:
+                data = encode_waveform(waveform)
+                fp.write(data)
+                index[track_id] = (offset, len(data))
+                offset += len(data)
+        with open(path + '.idx.tmp', 'wb') as fp:
+            json.dump(index, fp)
+
+        os.rename(path + '.bin.tmp', path + '.bin')
+        os.rename(path + '.idx.tmp', path + '.idx')
+        return len(index)
+
+
+def encode_waveform(waveform):
+    return str(bytearray(min(max(int(value), 0), 255) for value in waveform))
+
+
+def decode_waveform(data):
+    return list(bytearray(data))